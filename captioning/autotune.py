@@ -0,0 +1,153 @@
+"""Finds the batch sizes, DataLoader workers and intra-op threads giving the most
+throughput on this machine, and saves them to `config.host_config_path`, which
+the entry points load.
+
+    python -m captioning.autotune
+    python -m captioning.autotune --targets first_stage feature_extraction
+
+Every candidate is a short timed probe in a fresh process: `autotune["steps"]`
+training steps, or feature extraction of as many validation images. Threads are
+tuned first, then workers, then the batch size, each keeping the best values
+found so far. Candidates whose peak memory goes over `autotune["max_memory"]` of
+the RAM are discarded. A different batch size changes the training itself, the
+learning rate may need to follow.
+"""
+import importlib
+import json
+import multiprocessing
+import os
+import resource
+from pathlib import Path
+
+from .config import (
+    autotune,
+    feature_extraction,
+    first_stage,
+    get_parser,
+    host_config_path,
+    parse_args,
+    second_stage,
+    set_setting,
+    settings_env,
+)
+
+TARGETS = {
+    "first_stage": ("captioning.train.first_stage", first_stage),
+    "second_stage": ("captioning.train.second_stage", second_stage),
+    "feature_extraction": (
+        "captioning.preprocessing.feature_extraction",
+        feature_extraction,
+    ),
+}
+
+
+def peak_rss():
+    """Peak resident memory in bytes of this process plus its largest finished
+    child, the DataLoader workers."""
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return (own + children) * 1024
+
+
+def probe(target, candidate, steps, results):
+    import torch
+
+    parse_args([])  # the settings come through the environment
+    for key, value in candidate.items():
+        set_setting(f"{target}.{key}", value)
+    torch.set_num_threads(candidate["threads"])
+    benchmark = importlib.import_module(TARGETS[target][0]).benchmark
+
+    samples, elapsed = benchmark(steps)  # loading the data and model isn't timed
+    results.put({"samples_per_sec": samples / elapsed, "peak_rss": peak_rss()})
+
+
+def run_probe(target, candidate, steps):
+    """None if the probe failed, e.g. killed for lack of memory."""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.SimpleQueue()
+    process = ctx.Process(target=probe, args=(target, candidate, steps, results))
+    process.start()
+    process.join()
+    return results.get() if process.exitcode == 0 else None
+
+
+def powers_of_two(limit):
+    values = [1]
+    while values[-1] * 2 <= limit:
+        values.append(values[-1] * 2)
+    return values
+
+
+def tune(target, steps, max_memory):
+    """Returns the best settings of `target`."""
+    settings = TARGETS[target][1]
+    cpus = len(os.sched_getaffinity(0))
+    best = {
+        "batch_size": settings["batch_size"],
+        "num_workers": settings["num_workers"],
+        "threads": settings["threads"] or cpus,
+    }
+    searches = {
+        "threads": sorted(set(powers_of_two(cpus)) | {cpus}),
+        "num_workers": [0] + powers_of_two(min(cpus, 16)),
+        "batch_size": [max(1, settings["batch_size"] * f // 2) for f in (1, 2, 4, 8)],
+    }
+
+    measured = {}
+    print(f"{target}:")
+    print(f"{'batch':>6} {'workers':>8} {'threads':>8} {'samples/s':>10} {'MiB':>7}")
+    for key, values in searches.items():
+        throughput = {}
+        for value in values:
+            candidate = {**best, key: value}
+            name = tuple(candidate.values())
+            if name not in measured:
+                measured[name] = run_probe(target, candidate, steps)
+                result = measured[name] or {"samples_per_sec": 0, "peak_rss": 0}
+                print(
+                    f"{candidate['batch_size']:>6} {candidate['num_workers']:>8} "
+                    f"{candidate['threads']:>8} {result['samples_per_sec']:>10.1f} "
+                    f"{result['peak_rss'] / 2 ** 20:>7.0f}"
+                )
+            result = measured[name]
+            if result is not None and result["peak_rss"] <= max_memory:
+                throughput[value] = result["samples_per_sec"]
+        if not throughput:
+            raise RuntimeError(
+                f"Every {target} probe of {key} {values} failed or went over the "
+                "memory limit, see the errors above"
+            )
+        best[key] = max(throughput, key=throughput.get)
+    return best
+
+
+def save(tuned, path):
+    """Adds the `tuned` settings to the host config, keeping the other ones."""
+    host = json.loads(path.read_text()) if path.exists() else {}
+    for target, settings in tuned.items():
+        host.update({f"{target}.{key}": value for key, value in settings.items()})
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(host, indent=2))
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--targets", nargs="+", choices=TARGETS, default=[*TARGETS])
+    parser.add_argument("--steps", type=int, help='autotune["steps"]')
+    parser.add_argument("-o", "--output", default=host_config_path)
+    args = parse_args(parser=parser)
+
+    os.environ.update(settings_env())  # for the probes
+    steps = args.steps or autotune["steps"]
+    ram = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    tuned = {
+        target: tune(target, steps, autotune["max_memory"] * ram)
+        for target in args.targets
+    }
+    save(tuned, Path(args.output))
+    print(f"Saved to {args.output}: {tuned}")
+
+
+if __name__ == "__main__":
+    main()
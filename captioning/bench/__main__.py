@@ -0,0 +1,119 @@
+"""Benchmarks of the hot paths on synthetic data, CPU only, nothing to download.
+
+    python -m captioning.bench                      # all the cases
+    python -m captioning.bench semstyle_forward -r 10
+    python -m captioning.bench --compare bench_results/1a2b3c4.json
+
+Sizes are in `config.bench`. Each case runs once to warm up, then `repeat` timed
+times. The results go to bench_results/<commit>.json, --compare prints the
+change of the median times against an earlier result and flags the cases which
+got slower than `bench["regression"]`.
+"""
+import argparse
+import json
+import platform
+import subprocess
+import time
+from datetime import datetime
+from pathlib import Path
+from statistics import fmean, median
+
+import torch
+
+from ..config import bench
+from .cases import CASES
+from .synthetic import Synthetic
+
+
+def measure(run, repeat):
+    run()  # warmup
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return {"min": min(times), "median": median(times), "mean": fmean(times)}
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_cases(names, repeat):
+    data = Synthetic()
+    results = {}
+    try:
+        for name in names:
+            run, items = CASES[name](data)
+            result = measure(run, repeat)
+            result["items"] = items
+            result["items_per_sec"] = items / result["median"]
+            results[name] = result
+            print(
+                f"{name:<36} {result['median'] * 1e3:>10.2f} ms "
+                f"{result['items_per_sec']:>10.1f} items/s"
+            )
+    finally:
+        data.close()
+    return results
+
+
+def compare(results, baseline_path):
+    baseline = json.loads(Path(baseline_path).read_text())
+    print(f"\nAgainst {baseline_path} ({baseline['commit']}):")
+    for name, result in results.items():
+        if name not in baseline["results"]:
+            continue
+        ratio = result["median"] / baseline["results"][name]["median"]
+        flag = "  SLOWER" if ratio > bench["regression"] else ""
+        print(f"{name:<36} {ratio:>7.2f}x{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cases", nargs="*", metavar="CASE", help=", ".join(CASES))
+    parser.add_argument("-r", "--repeat", type=int, default=bench["repeat"])
+    parser.add_argument("--threads", type=int, help="defaults to the torch default")
+    parser.add_argument("-o", "--output", help="defaults to bench_results/<commit>")
+    parser.add_argument("--compare", metavar="BASELINE", help="an earlier result")
+    args = parser.parse_args()
+    unknown = set(args.cases) - set(CASES)
+    if unknown:
+        parser.error(f"Unknown cases {sorted(unknown)}")
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    commit = current_commit()
+    results = run_cases(args.cases or [*CASES], args.repeat)
+    report = {
+        "commit": commit,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "torch": torch.__version__,
+        "threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "sizes": bench,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    output = Path(args.output or f"bench_results/{commit or 'unknown'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Saved to {output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
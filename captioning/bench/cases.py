@@ -0,0 +1,143 @@
+"""The benchmark cases. Each one prepares its inputs from a Synthetic and returns
+the function to time, along with the number of items (captions, images, samples)
+it processes per call."""
+import torch
+from torch import nn
+from torch.utils.data.dataloader import default_collate
+
+from ..train.misc import extract_caption_len
+
+CASES = {}
+
+
+def case(func):
+    CASES[func.__name__] = func
+    return func
+
+
+@case
+def prepare_for_training(data):
+    """WordIdxMap.prepare_for_training over the COCO-like captions."""
+    dataset = data.second_stage_dataset
+    mapping = dataset.get_cap_mapping
+    captions = [ann["caption_words"] for ann in dataset.coco]
+
+    def run():
+        for words in captions:
+            mapping.prepare_for_training(words, max_caption_len=60)
+
+    return run, len(captions)
+
+
+def batch_of(dataset, batch_size):
+    return default_collate([dataset[i] for i in range(batch_size)])
+
+
+@case
+def first_stage_getitem_collate(data):
+    """A batch of QuickCocoDataset.__getitem__ and the default collate."""
+    dataset, batch_size = data.first_stage_dataset, data.sizes["batch_size"]
+    return lambda: batch_of(dataset, batch_size), batch_size
+
+
+@case
+def second_stage_getitem_collate(data):
+    """A batch of BalancedTolkienDataset.__getitem__ and the default collate."""
+    dataset, batch_size = data.second_stage_dataset, data.sizes["batch_size"]
+    return lambda: batch_of(dataset, batch_size), batch_size
+
+
+@case
+def term_decoder_forward_eval(data):
+    model = data.term_decoder.eval()
+    mapping = data.first_stage_dataset.get_term_mapping
+    feats = torch.rand(1, data.sizes["hidden_dim"])
+
+    def run():
+        with torch.no_grad():
+            model.forward_eval(feats, mapping)
+
+    return run, 1
+
+
+@case
+def language_generator_forward_eval(data):
+    model = data.language_generator.eval()
+    dataset = data.second_stage_dataset
+    terms = dataset.get_term_mapping.prepare_for_training(
+        dataset.coco[0]["terms"], max_caption_len=20, terms=True
+    )
+    terms, lengths = extract_caption_len(torch.LongTensor([terms]))
+
+    def run():
+        with torch.no_grad():
+            model.forward_eval(terms, lengths, dataset.get_cap_mapping)
+
+    return run, 1
+
+
+@case
+def first_stage_train_step(data):
+    """Forward, loss, backward and optimizer step, as in train.first_stage."""
+    model = data.term_decoder.train()
+    criterion = nn.NLLLoss()
+    optimizer = torch.optim.Adam(model.parameters())
+    features, captions = batch_of(data.first_stage_dataset, data.sizes["batch_size"])
+    captions, caption_lens = extract_caption_len(captions)
+    caption_lens = caption_lens + 1  # <start>
+    targets = captions[:, 1:]
+
+    def run():
+        optimizer.zero_grad()
+        outputs, _ = model(features, captions[:, :-1], caption_lens)
+        loss = criterion(outputs.permute(0, 2, 1), targets)
+        loss.backward()
+        optimizer.step()
+
+    return run, len(features)
+
+
+@case
+def second_stage_train_step(data):
+    """Forward, loss, backward and optimizer step, as in train.second_stage."""
+    model = data.language_generator.train()
+    criterion = nn.NLLLoss(ignore_index=0)
+    optimizer = torch.optim.Adam(model.parameters())
+    caps, terms = batch_of(data.second_stage_dataset, data.sizes["batch_size"])
+    caps, clens = extract_caption_len(torch.stack(caps).T)
+    terms, tlens = extract_caption_len(torch.stack(terms).T)
+    targets = caps[:, 1:]
+
+    def run():
+        optimizer.zero_grad()
+        loss, _, _ = model.loss(
+            terms, tlens, caps[:, :-1], clens + 1, targets, criterion
+        )
+        loss.backward()
+        optimizer.step()
+
+    return run, len(caps)
+
+
+@case
+def feature_extraction(data):
+    """The ResNet-101 features of one image."""
+    model, img = data.extractor, data.image()
+
+    def run():
+        with torch.no_grad():
+            model(img)
+
+    return run, 1
+
+
+@case
+def semstyle_forward(data):
+    """Image to styled caption, both stages."""
+    model, img = data.semstyle, data.image()
+
+    def run():
+        with torch.no_grad():
+            model(img, "<shake_modern>")
+
+    return run, 1
@@ -0,0 +1,133 @@
+"""Synthetic corpora, features and models with the shapes of the real ones. The
+files go to a temporary folder, read through the real dataset classes."""
+
+import json
+import random
+from functools import cached_property
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import h5py
+import numpy as np
+import torch
+
+from ..config import bench
+from ..dataset import BalancedTolkienDataset, QuickCocoDataset
+from ..model import (
+    FeatureExtractor,
+    ImgToTermNet,
+    LanguageGenerator,
+    SemStyle,
+    SentenceDecoderWithAttention,
+    TermDecoder,
+    TermEncoder,
+)
+from ..train.misc import filter_short
+
+
+def make_final(path, n, words, terms, rng, images=None):
+    """A final file of `n` captions, with image ids if `images` is given."""
+    anns = []
+    for i in range(n):
+        ann = {
+            "caption_words": rng.choices(words, k=rng.randint(8, 20)),
+            "terms": rng.choices(terms, k=rng.randint(4, 10)),
+        }
+        if images is not None:
+            ann["img_id"] = i % images
+        anns.append(ann)
+    path.write_text(json.dumps(anns))
+
+
+def make_features(path, images, dim, seed):
+    rng = np.random.default_rng(seed)
+    with h5py.File(path, "w") as f:
+        f["features"] = rng.random((images, dim), dtype=np.float32)
+        f["ids"] = np.arange(images, dtype=np.int32)
+
+
+class Synthetic:
+    """Everything a benchmark case may need, built on first use."""
+
+    def __init__(self, sizes=bench, seed=0):
+        self.sizes = sizes
+        self.tmp = TemporaryDirectory(prefix="captioning_bench_")
+        folder = Path(self.tmp.name)
+        self.coco_final = folder / "coco_final.json"
+        self.tolkien_final = folder / "tolkien_final.json"
+        self.features = folder / "features.hdf5"
+
+        rng = random.Random(seed)
+        words = [f"word{i}" for i in range(sizes["vocabulary"])]
+        terms = words[: len(words) // 5]
+        make_final(
+            self.coco_final, sizes["captions"], words, terms, rng, sizes["images"]
+        )
+        make_final(self.tolkien_final, sizes["captions"], words, terms, rng)
+        make_features(self.features, sizes["images"], sizes["hidden_dim"], seed)
+        torch.manual_seed(seed)
+
+    @cached_property
+    def first_stage_dataset(self):
+        return QuickCocoDataset(
+            self.features, self.coco_final, self.tolkien_final, filter_fn=filter_short
+        )
+
+    @cached_property
+    def second_stage_dataset(self):
+        return BalancedTolkienDataset(
+            self.coco_final, self.tolkien_final, encode=True, filter_fn=filter_short
+        )
+
+    @cached_property
+    def extractor(self):
+        return FeatureExtractor(pretrained=False).eval()
+
+    @cached_property
+    def term_decoder(self):
+        hidden = self.sizes["hidden_dim"]
+        mapping = self.first_stage_dataset.get_term_mapping
+        return TermDecoder(len(mapping), hidden, hidden)
+
+    @cached_property
+    def language_generator(self):
+        return self.make_language_generator()
+
+    def make_language_generator(self, cutoffs=None):
+        """A new LanguageGenerator, with the adaptive softmax if `cutoffs` is
+        given."""
+        hidden = self.sizes["hidden_dim"]
+        dataset = self.second_stage_dataset
+        cmapping, tmapping = dataset.get_cap_mapping, dataset.get_term_mapping
+        enc = TermEncoder(len(tmapping), hidden)
+        dec = SentenceDecoderWithAttention(
+            len(cmapping),
+            hidden,
+            len(cmapping),
+            cutoffs=cutoffs,
+            frequencies=cmapping.frequencies(),
+        )
+        return LanguageGenerator(enc, dec)
+
+    @cached_property
+    def semstyle(self):
+        return self.make_semstyle(self.language_generator)
+
+    def make_semstyle(self, language_generator):
+        dataset = self.second_stage_dataset
+        return SemStyle(
+            ImgToTermNet(self.term_decoder, self.extractor),
+            language_generator,
+            self.first_stage_dataset.get_term_mapping,
+            dataset.get_term_mapping,
+            dataset.get_cap_mapping,
+        ).eval()
+
+    def image(self):
+        """A random image, of the size of a 640x480 COCO image once transformed."""
+        return torch.rand(1, 3, 256, 341)
+
+    def close(self):
+        if "first_stage_dataset" in self.__dict__:
+            self.first_stage_dataset.close()
+        self.tmp.cleanup()
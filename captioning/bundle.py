@@ -0,0 +1,138 @@
+"""Self-contained SemStyle bundles: the weights of both stages, the three
+vocabularies and the hyperparameters in a single file.
+
+Loading a bundle needs neither `captioning.config` nor the training datasets:
+
+    model = load_bundle("runs/exp_000/semstyle_bundle.pt", mmap=True)
+
+Create one from the latest checkpoints with `python -m captioning.bundle`.
+"""
+import inspect
+from contextlib import nullcontext
+
+import torch
+
+from .model import (
+    FeatureExtractor,
+    ImgToTermNet,
+    LanguageGenerator,
+    SemStyle,
+    SentenceDecoderWithAttention,
+    TermDecoder,
+    TermEncoder,
+)
+from .utils import WordIdxMap
+
+BUNDLE_VERSION = 1
+
+
+def _vocab(mapping):
+    return {"idx2word": mapping.idx2word, "counts": mapping.counts}
+
+
+def save_bundle(model, path):
+    """Saves a (not quantized) SemStyle model."""
+    term_decoder = model.img_to_term.term_decoder
+    dec = model.language_generator.dec
+    hparams = {
+        "term_hidden_dim": term_decoder.hidden_dim,
+        "encoder_dim": term_decoder.init_gru_hidden[0].in_features,
+        "lang_hidden_dim": dec.hidden_size,
+        "cutoffs": None if dec.adaptive is None else dec.adaptive.cutoffs[:-1],
+        "max_len": model.max_len,
+    }
+    torch.save(
+        {
+            "version": BUNDLE_VERSION,
+            "hparams": hparams,
+            "vocabs": {
+                "mmap": _vocab(model.mmap),
+                "tmap": _vocab(model.tmap),
+                "cmap": _vocab(model.cmap),
+            },
+            "img_to_term": model.img_to_term.state_dict(),
+            "language_generator": model.language_generator.state_dict(),
+        },
+        path,
+    )
+
+
+def mmap_supported():
+    """Whether torch.load can memory-map a bundle (torch >= 2.1)."""
+    return "mmap" in inspect.signature(torch.load).parameters
+
+
+def load_bundle(
+    path, device="cpu", mmap=False, quantize=False, cache=None, caption_cache=None
+):
+    """Builds a SemStyle model in eval mode from a bundle.
+
+    Args:
+        device (str, optional): Defaults to "cpu".
+        mmap (bool, optional): Memory-map the weights instead of reading them,
+            requires torch >= 2.1 and device="cpu". Defaults to False.
+        quantize (bool, optional): Dynamic int8 quantization, see
+            captioning.quantization. Defaults to False.
+        cache, caption_cache (LRUCache, optional): See ImgToTermNet and SemStyle.
+    """
+    if mmap and not mmap_supported():
+        raise RuntimeError("Memory-mapped bundles require torch >= 2.1")
+
+    load_kwargs = {"mmap": True} if mmap else {}
+    bundle = torch.load(path, map_location="cpu", **load_kwargs)
+    if bundle["version"] != BUNDLE_VERSION:
+        raise RuntimeError(f"Unsupported bundle version {bundle['version']}")
+
+    hp = bundle["hparams"]
+    mmap_, tmap, cmap = (
+        WordIdxMap.from_idx2word(**bundle["vocabs"][name])
+        for name in ("mmap", "tmap", "cmap")
+    )
+
+    # With mmap the parameters are only allocated as placeholders and then
+    # swapped for the memory-mapped tensors, skipping the random initialization.
+    with torch.device("meta") if mmap else nullcontext():
+        term_decoder = TermDecoder(len(mmap_), hp["term_hidden_dim"], hp["encoder_dim"])
+        img_to_term = ImgToTermNet(
+            term_decoder, extractor=FeatureExtractor(pretrained=False), cache=cache
+        )
+        enc = TermEncoder(len(tmap), hp["lang_hidden_dim"])
+        dec = SentenceDecoderWithAttention(
+            len(cmap), hp["lang_hidden_dim"], len(cmap), cutoffs=hp["cutoffs"]
+        )
+        lang = LanguageGenerator(enc, dec)
+
+    assign = {"assign": True} if mmap else {}
+    img_to_term.load_state_dict(bundle["img_to_term"], **assign)
+    lang.load_state_dict(bundle["language_generator"], **assign)
+
+    if quantize:
+        from .quantization import quantize_dynamic
+
+        img_to_term.term_decoder = quantize_dynamic(img_to_term.term_decoder)
+        lang = quantize_dynamic(lang)
+
+    model = SemStyle(
+        img_to_term, lang, mmap_, tmap, cmap, caption_cache, max_len=hp["max_len"]
+    )
+    return model.to(device).eval()
+
+
+def main():
+    from .config import experiment_folder
+    from .run.__main__ import get_mappings, get_models
+
+    cmap, tmap1, tmap = get_mappings()
+    term_gen, lang_gen = get_models(cmap, tmap1, tmap, quantize="none")
+    model = SemStyle(term_gen, lang_gen, tmap1, tmap, cmap)
+
+    path = experiment_folder / "semstyle_bundle.pt"
+    save_bundle(model, path)
+    print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    from .config import parse_args
+
+    parse_args()
+    main()
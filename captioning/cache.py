@@ -0,0 +1,96 @@
+"""Bounded LRU caches for inference results."""
+import hashlib
+import sys
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import torch
+
+
+def content_key(data) -> str:
+    """Hash of raw bytes, a file (given its path) or a tensor's contents."""
+    if isinstance(data, torch.Tensor):
+        data = data.detach().cpu().contiguous().numpy().tobytes()
+    elif isinstance(data, (str, Path)):
+        data = Path(data).read_bytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+def nbytes(value) -> int:
+    """Approximate memory taken by a value: tensors, numbers and strings in
+    (nested) tuples, lists and dicts."""
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(nbytes(v) for v in value.values())
+    if isinstance(value, (tuple, list)):
+        return sum(nbytes(v) for v in value)
+    return sys.getsizeof(value)
+
+
+class LRUCache:
+    """Least recently used cache bounded by the total `sizeof` of its values.
+    Thread safe.
+
+    Args:
+        max_size (int): Memory bound, in units of `sizeof`.
+        sizeof (callable, optional): Size of a value. Defaults to 1 per entry.
+    """
+
+    def __init__(self, max_size, sizeof=None):
+        self.max_size = max_size
+        self.sizeof = sizeof or (lambda value: 1)
+        self.entries = OrderedDict()
+        self.size = 0
+
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._put(key, value)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0,
+            "entries": len(self.entries),
+            "size": self.size,
+        }
+
+    def _put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_size:
+            return
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (value, size)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
@@ -1,35 +1,340 @@
+"""Project configuration.
+
+Importing this module is cheap and has no side effects. Settings which depend on
+the command line (see `get_parser`) are read from the environment
+(e.g. CAPTIONING_EXPERIMENT=3) until an entry point calls `parse_args`, which also
+creates the data directories and sets up logging. They are resolved on attribute
+access, so use them as `config.device` rather than `from config import device`.
+"""
 import argparse
+import ast
 import glob
+import json
 import logging
 import os
+from contextlib import nullcontext
 from functools import lru_cache
 from pathlib import Path
 
-import torch
-from torchvision.datasets.coco import CocoCaptions
-from torchvision.transforms import transforms
-
 
 def lazy(func):
     return lru_cache(maxsize=1)(func)
 
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-t", "--word_occurance_threshold", type=int, default=25)
-parser.add_argument("-i", "--interactive", action="store_true")
-parser.add_argument("-x", "--experiment", type=int, default=0)
-args = parser.parse_args()
+def _env(name, default, type=str):
+    value = os.environ.get(f"CAPTIONING_{name.upper()}")
+    if value is None:
+        return default
+    if type is bool:
+        return value.lower() in ("1", "true", "yes")
+    return type(value)
+
+
+def encode_list(values):
+    """A list of strings as an environment variable value, see `decode_list`.
+
+    >>> values = ["a.b=[2000, 10000]", "c.d='x y'"]
+    >>> decode_list(encode_list(values)) == values
+    True
+    """
+    return json.dumps(values)
+
+
+def decode_list(value):
+    """Reads `encode_list`, or whitespace separated values."""
+    return json.loads(value) if value.startswith("[") else value.split()
+
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "-t",
+        "--word_occurance_threshold",
+        type=int,
+        default=_env("word_occurance_threshold", 25, int),
+    )
+    parser.add_argument(
+        "-i",
+        "--interactive",
+        action="store_true",
+        default=_env("interactive", False, bool),
+    )
+    parser.add_argument(
+        "-x", "--experiment", type=int, default=_env("experiment", 0, int)
+    )
+    # Mixed precision for the forward passes: bf16 covers the CNN, the Linear layers
+    # and the attention, the GRUs and the losses are always computed in fp32
+    parser.add_argument(
+        "-p",
+        "--precision",
+        choices=["fp32", "bf16"],
+        default=_env("precision", "fp32"),
+    )
+    # Per step timings of the training loops as JSONL, see train.instrument
+    parser.add_argument(
+        "--trace", action="store_true", default=_env("trace", False, bool)
+    )
+    # Score the checkpoints in a separate process, see train.evaluator
+    parser.add_argument(
+        "--background_eval",
+        action="store_true",
+        default=_env("background_eval", False, bool),
+    )
+    # torch.profiler traces of the training loops and the server, see profiling
+    parser.add_argument(
+        "--profile", action="store_true", default=_env("profile", False, bool)
+    )
+    # Continue the training from the last saved state, see train.checkpoint
+    parser.add_argument(
+        "--resume", action="store_true", default=_env("resume", False, bool)
+    )
+    # int8 inference: "dynamic" quantizes the GRU and Linear layers, "static" also
+    # the CNN and needs the checkpoints, it isn't supported with a bundle
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        choices=["none", "dynamic", "static"],
+        default=_env("quantize", "none"),
+    )
+    # Changes to the settings dicts below, e.g. --set first_stage.batch_size=32.
+    # CAPTIONING_OVERRIDES takes a JSON list of them
+    parser.add_argument(
+        "--set",
+        action="append",
+        dest="overrides",
+        metavar="DICT.KEY=VALUE",
+        default=_env("overrides", [], decode_list),
+    )
+    return parser
+
+
+_args = None
+_device = None
+
+
+def parse_args(argv=None, parser=None):
+    """Reads the command line. Meant to be called once, by the entry points.
+
+    Args:
+        argv (list, optional): Defaults to sys.argv[1:].
+        parser (ArgumentParser, optional): Entry points with their own options
+            should extend `get_parser()` and pass it here.
+
+    Returns:
+        Namespace: the parsed arguments
+    """
+    global _args
+    _args = (parser or get_parser()).parse_args(argv)
+    load_host_config()
+    apply_overrides(_args.overrides)
+
+    for p in (computed_path, new_format_path, _experiment_folder()):
+        os.makedirs(p, exist_ok=True)
+
+    setup_logging()
+    return _args
+
+
+def settings():
+    """The parsed command line, or the defaults if `parse_args` wasn't called."""
+    global _args
+    if _args is None:
+        _args = get_parser().parse_args([])
+        load_host_config()
+        apply_overrides(_args.overrides)
+    return _args
+
+
+def settings_env():
+    """The command line settings as CAPTIONING_* environment variables, to pass
+    them on to subprocesses."""
+    env = {}
+    for name in vars(get_parser().parse_args([])):
+        value = getattr(settings(), name)
+        if isinstance(value, list):
+            value = encode_list(value)
+        env[f"CAPTIONING_{name.upper()}"] = str(value)
+    return env
+
+
+def set_setting(key, value):
+    """Updates a settings dict in place, e.g. `set_setting("bulk.batch_size", 8)`.
+    Modules which imported the dict see the change."""
+    name, _, entry = key.partition(".")
+    settings_dict = globals().get(name)
+    if not isinstance(settings_dict, dict) or entry not in settings_dict:
+        raise ValueError(f"Unknown setting {key}")
+    settings_dict[entry] = value
+
+
+def apply_overrides(overrides):
+    """Applies --set. Values are read as Python literals, as strings if they aren't
+    one."""
+    for override in overrides:
+        key, _, value = override.partition("=")
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            pass
+        set_setting(key, value)
+
+
+def load_host_config(path=None):
+    """Applies the settings tuned for this machine by `python -m
+    captioning.autotune`, if it was run. --set takes precedence."""
+    path = Path(path or host_config_path)
+    if path.exists():
+        for key, value in json.loads(path.read_text()).items():
+            set_setting(key, value)
+
+
+def experiment_path(experiment):
+    return Path(f"runs/exp_{experiment:03d}")
+
+
+def _experiment_folder():
+    return experiment_path(settings().experiment)
+
+
+def __getattr__(name):
+    """Lazily resolved settings: everything `settings()` has, `device`,
+    `experiment_folder` and `image_transform`."""
+    if name == "device":
+        return _device or _default_device()
+    if name == "experiment_folder":
+        return _experiment_folder()
+    if name == "image_transform":
+        return _image_transform()
+    if not name.startswith("_") and hasattr(settings(), name):
+        return getattr(settings(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@lazy
+def _default_device():
+    import torch
+
+    return torch.device("cpu" if not torch.cuda.is_available() else "cuda:0")
+
+
+first_stage = {
+    "batch_size": 16,
+    "learning_rate": 0.001,
+    "epochs": 10,
+    "eval_batch_size": 256,
+    "eval_size": None,  # validation images to score, None for all of them
+    "num_workers": 4,
+    "threads": None,  # intra-op threads, None for the torch default
+}
+second_stage = {
+    "batch_size": 32,
+    "learning_rate": 0.001,
+    "epochs": 30,
+    # e.g. [2000, 10000] to use the adaptive softmax for the caption vocabulary
+    "adaptive_softmax_cutoffs": None,
+    "eval_batch_size": 256,
+    "num_workers": 4,
+    "threads": None,
+}
+
+# preprocessing.feature_extraction, images of the same size go through the CNN
+# together
+feature_extraction = {
+    "batch_size": 16,
+    "num_workers": 4,
+    "threads": None,
+}
+
+# Best batch sizes, workers and threads for this machine, written by
+# `python -m captioning.autotune`
+host_config_path = Path(
+    os.environ.get("CAPTIONING_HOST_CONFIG", "~/.config/captioning/host.json")
+).expanduser()
+
+# Background scoring of the checkpoints, see train.evaluator
+evaluator = {
+    "poll": 30,  # seconds between looking for new checkpoints
+    "settle": 5,  # seconds a checkpoint must be left untouched before it's read
+    "threads": 2,  # leave the rest of the cores to the training
+}
+
+# Full training state, see train.checkpoint
+checkpoint = {
+    "every_steps": 1000,  # also saved after each epoch
+}
+
+# --profile, see profiling
+profiler = {
+    "wait": 10,  # steps (or server batches) before profiling
+    "warmup": 3,
+    "active": 10,  # steps recorded
+    "record_shapes": True,
+    "profile_memory": True,
+    "with_stack": False,  # source locations, makes the traces much bigger
+    "row_limit": 40,  # operators in the summary table
+}
+
+# Hyperparameter sweeps, see train.sweep
+sweep = {
+    "parallel": 2,  # concurrent trials, the cores are split evenly between them
+    "poll": 30,  # seconds between looking at the losses of the trials
+    "window": 50,  # steps of loss averaged by the median stopping rule
+    "grace_steps": 500,  # no trial is stopped before reaching this step
+    "min_trials": 3,  # other trials that must have reached a step to compare to
+}
+
+# Probes of python -m captioning.autotune
+autotune = {
+    "steps": 30,  # training steps per probe, images for feature_extraction
+    "max_memory": 0.8,  # share of the RAM, candidates using more are discarded
+}
 
-# Data processing metaparameters
-word_occurance_threshold = args.word_occurance_threshold
+# Benchmark suite on synthetic data, see bench
+bench = {
+    "images": 64,  # rows of synthetic image features
+    "captions": 2000,  # per corpus, COCO-like and Tolkien-like
+    "vocabulary": 1000,  # caption words, the terms are a fifth of them
+    "hidden_dim": 2048,  # as in the real models
+    "batch_size": 16,
+    "repeat": 5,  # timed runs of each case, after a warmup run
+    "regression": 1.1,  # slowdown flagged by --compare
+}
 
-gpu_num = 0
-device_str = "cpu" if not torch.cuda.is_available() else f"cuda:{gpu_num}"
-device = torch.device(device_str)
+# Time and memory of python -m captioning.preprocessing, see preprocessing.accounting
+preprocessing_report = {
+    "tracemalloc": True,  # Python allocations by source line, slows the steps down
+    "frames": 1,  # traceback depth of the allocations
+    "top": 10,  # allocation sites listed per step
+}
 
-first_stage = {"batch_size": 16, "learning_rate": 0.001, "epochs": 10}
-second_stage = {"batch_size": 32, "learning_rate": 0.001, "epochs": 30}
-experiment_folder = Path(f"runs/exp_{args.experiment:03d}")
+# Captioning service (run/server.py)
+server = {
+    "host": "127.0.0.1",
+    "port": 8080,
+    "max_batch_size": 8,
+    "max_wait": 0.01,  # seconds to wait for a batch to fill up
+    "max_image_bytes": 16 * 2 ** 20,
+    "image_cache_bytes": 256 * 2 ** 20,
+    "caption_cache_entries": 10000,
+    "workers": 4,  # run.prefork
+    "threads_per_worker": None,  # defaults to cpu_count / workers
+}
+
+# Data-parallel CPU training, see train.distributed
+distributed = {
+    "backend": "gloo",
+    "master_addr": "127.0.0.1",
+    "master_port": 29500,
+    "nprocs": 4,
+    "scaling_steps": 50,  # per process, for --scaling
+}
+
+# Offline captioning, see run.bulk
+bulk = {
+    "batch_size": 32,
+    "num_workers": 4,
+    "extensions": (".jpg", ".jpeg", ".png"),
+}
 
 max_caption_len = 20
 
@@ -39,10 +344,6 @@ computed_path = Path("/data/computed_shake/")
 new_format_path = Path("/data/new_format")
 
 
-for p in (computed_path, new_format_path, experiment_folder):
-    if not p.exists():
-        os.makedirs(p, exist_ok=True)
-
 coco_train_conf = {
     "name": "Train",
     "imgs_root_path": mscoco_root_path / "train2014",
@@ -91,23 +392,38 @@ tolkien_conf = {
 plays_path = "/data/shake/merged"
 nltk_data_path = "/home/malpunek/.nltk_data"
 
-# Various script options
+logger = logging.getLogger(__package__)
 
-interactive = args.interactive
 
-logging.basicConfig(format="LIB %(name)s: %(message)s")
+def setup_logging():
+    if logger.handlers:
+        return
 
-_handler = logging.StreamHandler()
-_handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
-logger = logging.getLogger(__package__)
-logger.setLevel(logging.DEBUG)
-logger.addHandler(_handler)
+    logging.basicConfig(format="LIB %(name)s: %(message)s")
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(handler)
 
 
 def last_checkpoint_path(stage=1):
     assert stage in (1, 2)
     stage = "model" if stage == 1 else "lang"
-    return sorted(experiment_folder.glob(f"{stage}*.pth"))[-1]
+    return sorted(_experiment_folder().glob(f"{stage}*.pth"))[-1]
+
+
+def autocast():
+    """Context manager running the enclosed forward passes in `precision`."""
+    if settings().precision == "fp32":
+        return nullcontext()
+
+    import torch
+
+    if not hasattr(torch, "autocast"):
+        raise RuntimeError("bf16 precision requires torch >= 1.10")
+    device = _device or _default_device()
+    return torch.autocast(device.type, dtype=torch.bfloat16)
 
 
 def setup_nltk():
@@ -117,22 +433,29 @@ def setup_nltk():
         nltk.data.path.append(nltk_data_path)
 
 
-image_transform = transforms.Compose(
-    [
-        transforms.Resize(256),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ]
-)
+# ######## Lazy #############
+@lazy
+def _image_transform():
+    from torchvision.transforms import transforms
+
+    return transforms.Compose(
+        [
+            transforms.Resize(256),
+            transforms.ToTensor(),
+            transforms.Normalize(
+                mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+            ),
+        ]
+    )
 
 
-# ######## Lazy #############
 def _get_dataset(dataset_conf):
+    from torchvision.datasets.coco import CocoCaptions
 
     return CocoCaptions(
         dataset_conf["imgs_root_path"],
         dataset_conf["original"],
-        transform=image_transform,
+        transform=_image_transform(),
     )
 
 
@@ -177,7 +500,9 @@ def first_stage_dataset():
         # shakespare_conf["final"],
         tolkien_conf["final"],
     ]
-    return QuickCocoDataset(*args, filter_fn=filter_short)
+    return QuickCocoDataset(
+        *args, filter_fn=filter_short, min_count=settings().word_occurance_threshold
+    )
     # return AllTermsDataset(*args)
 
 
@@ -191,6 +516,7 @@ def second_stage_dataset():
         tolkien_conf["final"],
         encode=True,
         filter_fn=filter_short,
+        min_count=settings().word_occurance_threshold,
     )
 
     # return BalancedLanguageDataset(
@@ -206,6 +532,8 @@ def second_stage_dataset():
 
 def lgpu():
     """Lists the GPUs found by PyTorch"""
+    import torch
+
     if not torch.cuda.is_available():
         print("Torch didn't find any available GPUs.")
         return
@@ -221,9 +549,11 @@ def lgpu():
 
 
 def pick_gpu():
-    global device, device_str
+    global _device
+
+    import torch
 
-    if not interactive:
+    if not settings().interactive:
         # Not interactive stick with the default
         device_str = "cpu" if not torch.cuda.is_available() else "cuda:0"
 
@@ -248,6 +578,6 @@ def pick_gpu():
                 continue
         device_str = f"cuda:{x}"
 
-    device = torch.device(device_str)
-    logger.info(f"Using {device}")
-    return device
+    _device = torch.device(device_str)
+    logger.info(f"Using {_device}")
+    return _device
@@ -1,4 +1,5 @@
 import json
+import logging
 import sys
 from collections import Counter
 from functools import cached_property
@@ -12,10 +13,13 @@ from tqdm.auto import tqdm
 
 from .utils import WordIdxMap
 
+logger = logging.getLogger(__name__)
+
 
 class SemStyleDataset(Dataset):
-    def __init__(self, coco_final_path, shake_final_path, filter_fn=None):
+    def __init__(self, coco_final_path, shake_final_path, filter_fn=None, min_count=1):
         super().__init__()
+        self.min_count = min_count
 
         with open(coco_final_path) as cf, open(shake_final_path) as sf:
             coco = json.load(cf)
@@ -39,7 +43,12 @@ class SemStyleDataset(Dataset):
             caps_vocab.update(cap["caption_words"])
             caps_vocab.update(cap.get("original_words", []))
 
-        return WordIdxMap(caps_vocab)
+        mapping = WordIdxMap(caps_vocab, min_count=self.min_count)
+        logger.info(
+            f"Caption vocabulary: {len(mapping)} of {len(caps_vocab)} words "
+            f"occur at least {self.min_count} times"
+        )
+        return mapping
 
     @cached_property
     def get_term_mapping(self):
@@ -51,7 +60,12 @@ class SemStyleDataset(Dataset):
         ):
             terms_vocab.update(cap["terms"])
 
-        return WordIdxMap(terms_vocab)
+        mapping = WordIdxMap(terms_vocab, min_count=self.min_count)
+        logger.info(
+            f"Term vocabulary: {len(mapping)} of {len(terms_vocab)} terms "
+            f"occur at least {self.min_count} times"
+        )
+        return mapping
 
     def _encode_caps(self, iterable, mapping, keyword, max_len=60):
         return [
@@ -307,6 +321,34 @@ class EvaluationDataset(ValidationDataset):
     ann_key = "caption"
 
 
+class LanguageValidationDataset(Dataset):
+    """(caption, terms) pairs of a final file, encoded like the training data of
+    the second stage with its mappings."""
+
+    def __init__(self, final_path, cap_mapping, term_mapping, filter_fn=None):
+        with open(final_path) as f:
+            anns = json.load(f)
+        if filter_fn is not None:
+            anns = list(filter(filter_fn, anns))
+
+        self.caps_enc = [
+            cap_mapping.prepare_for_training(ann["caption_words"], max_caption_len=60)
+            for ann in anns
+        ]
+        self.terms_enc = [
+            term_mapping.prepare_for_training(
+                ann["terms"], max_caption_len=20, terms=True
+            )
+            for ann in anns
+        ]
+
+    def __len__(self):
+        return len(self.caps_enc)
+
+    def __getitem__(self, idx):
+        return self.caps_enc[idx], self.terms_enc[idx]
+
+
 class AllTermsDataset(SemStyleDataset, FeatureMixin):
     def __init__(self, features_path, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -1,14 +1,22 @@
+import asyncio
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
 import torch
 import torch.nn.functional as F
 from torch import nn
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.autograd.profiler import record_function
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
 from torchvision.models import resnet101
 
+from .cache import content_key
+
 
 class FeatureExtractor(nn.Module):
-    def __init__(self):
+    def __init__(self, pretrained=True):
         super().__init__()
-        self.resnet = resnet101(pretrained=True)
+        self.resnet = resnet101(pretrained=pretrained)
         self.resnet.fc = nn.Sequential()
         self.resnet.out_features = self.out_features = 2048
 
@@ -50,11 +58,12 @@ class TermDecoder(nn.Module):
         Returns:
             tuple(Tensor, Tensor) scores for vocabulary
         """
-        hidden = self.init_gru_hidden(encoder_out)  # (batch_size, decoder_dim)
-        hidden = hidden.unsqueeze(
-            0
-        )  # GRU expects first dimension to be num_layers * num_directions
-        return self.forward_hidden(hidden, encoded_captions, caption_lengths)
+        with record_function("term_decoder"):
+            hidden = self.init_gru_hidden(encoder_out)  # (batch_size, decoder_dim)
+            hidden = hidden.unsqueeze(
+                0
+            )  # GRU expects first dimension to be num_layers * num_directions
+            return self.forward_hidden(hidden, encoded_captions, caption_lengths)
 
     def forward_hidden(self, hidden, encoded_captions, caption_lengths):
         """Forward propagation with initiated hidden state."""
@@ -64,6 +73,9 @@ class TermDecoder(nn.Module):
         )  # (batch_size, max_caption_length, embed_dim)
         embeddings = self.emb_drop(embeddings)
         embeddings = F.relu(embeddings)  # inspired by pytorch nlp
+        # autocast doesn't cover GRUs, they run in fp32 on the fp32 embeddings, but
+        # init_gru_hidden returns bf16 under autocast
+        hidden = hidden.float()
         embeddings = pack_padded_sequence(
             embeddings, caption_lengths, batch_first=True, enforce_sorted=False
         )
@@ -75,7 +87,7 @@ class TermDecoder(nn.Module):
             out_terms, batch_first=True, total_length=target_len
         )
         # (batch, max_len, hidden_dim)
-        out_terms = self.fc(out_terms)
+        out_terms = self.fc(out_terms).float()
         # (batch, max_len, vocab_size)
         out_terms = F.log_softmax(out_terms, dim=2)
 
@@ -125,18 +137,143 @@ class TermDecoder(nn.Module):
 
         return list(mapping.decode(words_decoded)), confidence
 
+    def forward_eval_batch(self, encoder_out, mapping, max_len=20):
+        """Batched version of forward_eval. Decoding stops once every sequence in
+        the batch has reached <end>.
+
+        Returns:
+            list(tuple(list, list)): terms and confidences for each batch element
+        """
+        return split_decoded(*self.decode_batch(encoder_out, mapping, max_len), mapping)
+
+    def decode_batch(self, encoder_out, mapping, max_len=20):
+        """Batched greedy decoding, as ids.
+
+        Returns:
+            tuple(list, list): the (batch, 1) tensors of word ids and confidences
+                of each step, <start> included
+        """
+        hidden = self.init_gru_hidden(encoder_out).unsqueeze(0)  # (1, batch, hidden)
+        batch_size = encoder_out.size(0)
+        start, end = mapping["<start>"], mapping["<end>"]
+
+        device = list(self.parameters())[0].device
+
+        last_words = torch.full((batch_size, 1), start, dtype=torch.long, device=device)
+        cap_len = torch.ones(batch_size, dtype=torch.long)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+        words_decoded = [last_words]
+        confidence = [torch.ones(batch_size, 1, device=device)]
+
+        for _ in range(1, max_len + 1):
+            with record_function("term_decoder_step"):
+                out_term, hidden = self.forward_hidden(hidden, last_words, cap_len)
+                topv, topi = out_term.topk(1)  # (batch_size, 1, 1)
+            last_words = topi.squeeze(2).detach()  # (batch_size, 1)
+            words_decoded.append(last_words)
+            confidence.append(torch.exp(topv.squeeze(2)))
+
+            finished |= last_words.squeeze(1) == end
+            if finished.all():
+                break
+
+        return words_decoded, confidence
+
+
+def without_autocast(device):
+    """Runs the enclosed operations in their own dtype, even under autocast."""
+    if not hasattr(torch, "autocast"):  # no autocast before torch 1.10
+        return nullcontext()
+    return torch.autocast(device.type, enabled=False)
+
+
+def split_decoded(words_decoded, confidence, mapping):
+    """Turns the per-step (batch, 1) tensors of a batched greedy decode into
+    per-element lists of words and confidences, cut after the first <end>."""
+    end = mapping["<end>"]
+    words_decoded = torch.cat(words_decoded, dim=1).tolist()
+    confidence = torch.cat(confidence, dim=1).tolist()
+
+    results = []
+    for words, conf in zip(words_decoded, confidence):
+        length = words.index(end) + 1 if end in words else len(words)
+        results.append((list(mapping.decode(words[:length])), conf[:length]))
+    return results
+
 
 class ImgToTermNet(nn.Module):
-    def __init__(self, term_decoder, extractor=None):
+    def __init__(self, term_decoder, extractor=None, cache=None):
+        """
+        Args:
+            cache (LRUCache, optional): Cache of the decoded terms, keyed
+                by the image contents.
+        """
         super().__init__()
         self.term_decoder = term_decoder
         self.extractor = extractor or FeatureExtractor()
+        self.cache = cache
 
-    def forward(self, img, mapping):
-        """Only for evaluation."""
-        feats = self.extractor(img)
-        terms, confidence = self.term_decoder.forward_eval(feats, mapping)
-        return terms, confidence
+    def forward(self, img, mapping, key=None):
+        """Only for evaluation.
+
+        Args:
+            key (str, optional): Cache key of the image, e.g. `content_key` of the
+                image file. Defaults to a hash of the image tensor.
+        """
+        return self.forward_batch([img], mapping, [key])[0]
+
+    def forward_batch(self, imgs, mapping, keys=None, with_ids=False):
+        """Only for evaluation. Terms for a list of images of shape (1, 3, H, W).
+        Cached images are skipped, the rest is decoded as one batch.
+
+        Args:
+            with_ids (bool, optional): Also return the term ids, without <start>
+                and <end>, as a LongTensor. Defaults to False.
+
+        Returns:
+            list(tuple(list, list)): terms and confidences (and ids) for each image
+        """
+        results = [None] * len(imgs)
+        if self.cache is not None:
+            keys = [
+                key or content_key(img) for key, img in zip(keys or results, imgs)
+            ]
+            results = [self.cache.get(key) for key in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            feats = self.extract_batch([imgs[i] for i in missing])
+            words, confidence = self.term_decoder.decode_batch(feats, mapping)
+            decoded = split_decoded(words, confidence, mapping)
+            ids = torch.cat(words, dim=1).cpu()
+            for i, (terms, conf), term_ids in zip(missing, decoded, ids):
+                results[i] = {
+                    "terms": terms,
+                    "confidence": conf,
+                    "ids": term_ids[1 : len(terms) - 1].clone(),
+                }
+                if self.cache is not None:
+                    self.cache.put(keys[i], results[i])
+
+        if with_ids:
+            return [(r["terms"], r["confidence"], r["ids"]) for r in results]
+        return [(r["terms"], r["confidence"]) for r in results]
+
+    def extract_batch(self, imgs):
+        """Features of shape (batch, out_features) of a list of (1, 3, H, W)
+        images. Images of the same size go through the CNN together."""
+        by_shape = defaultdict(list)
+        for i, img in enumerate(imgs):
+            by_shape[img.shape].append(i)
+
+        feats = [None] * len(imgs)
+        for idxs in by_shape.values():
+            with record_function("image_encoder"):
+                out = self.extractor(torch.cat([imgs[i] for i in idxs]))
+            for i, feat in zip(idxs, out):
+                feats[i] = feat
+        return torch.stack(feats)
 
 
 class TermEncoder(nn.Module):
@@ -160,6 +297,10 @@ class TermEncoder(nn.Module):
         self.hidden_init_p = torch.nn.Parameter(hidden_init)
 
     def forward(self, encoded_terms, hidden, lengths):
+        with record_function("term_encoder"):
+            return self._forward(encoded_terms, hidden, lengths)
+
+    def _forward(self, encoded_terms, hidden, lengths):
         target_len = encoded_terms.size(1)
 
         embdeddings = self.embedding(encoded_terms)
@@ -187,7 +328,23 @@ class TermEncoder(nn.Module):
 class SentenceDecoderWithAttention(nn.Module):
     """Decoder part of language generator."""
 
-    def __init__(self, vocab_size, hidden_size, output_size, out_bias=None):
+    def __init__(
+        self,
+        vocab_size,
+        hidden_size,
+        output_size,
+        out_bias=None,
+        cutoffs=None,
+        frequencies=None,
+    ):
+        """
+        Args:
+            cutoffs (list, optional): Enables the adaptive softmax output layer with
+                the given cluster cutoffs (see nn.AdaptiveLogSoftmaxWithLoss).
+            frequencies (list, optional): Word counts aligned with the output
+                indices, used to assign words to the adaptive softmax clusters.
+                Only used together with `cutoffs`.
+        """
         super().__init__()
         self.hidden_size = hidden_size
         self.vocab_size = vocab_size
@@ -198,56 +355,124 @@ class SentenceDecoderWithAttention(nn.Module):
         self.gru = nn.GRU(hidden_size, hidden_size, batch_first=True)
         self.gru_drop = nn.Dropout(0.2)
 
-        self.mlp = nn.Linear(hidden_size * 2, output_size)
-        if out_bias is not None:
-            out_bias_tensor = torch.tensor(out_bias, requires_grad=False)
-            self.mlp.bias.data[:] = out_bias_tensor
+        if cutoffs is None:
+            self.adaptive = None
+            self.mlp = nn.Linear(hidden_size * 2, output_size)
+            if out_bias is not None:
+                out_bias_tensor = torch.tensor(out_bias, requires_grad=False)
+                self.mlp.bias.data[:] = out_bias_tensor
+        else:
+            if out_bias is not None:
+                raise ValueError("out_bias is not supported with the adaptive softmax")
+            self.adaptive = nn.AdaptiveLogSoftmaxWithLoss(
+                hidden_size * 2, output_size, cutoffs, div_value=4.0
+            )
+            # The adaptive softmax expects the most frequent words first. Instead of
+            # reordering the vocabulary we keep a permutation: idx -> frequency rank.
+            if frequencies is None:
+                idx2rank = torch.arange(output_size)
+            else:
+                order = torch.tensor(frequencies).argsort(descending=True)
+                idx2rank = torch.empty_like(order)
+                idx2rank[order] = torch.arange(output_size)
+            self.register_buffer("idx2rank", idx2rank)
         self.logsoftmax = nn.LogSoftmax(dim=2)
 
         self.att_mlp = nn.Linear(hidden_size, hidden_size, bias=False)
         self.attn_softmax = nn.Softmax(dim=2)
 
-    def forward(self, input, hidden, encoder_outs, input_lengths=None):
+    def forward(
+        self, input, hidden, encoder_outs, input_lengths=None, encoder_mask=None
+    ):
         """Decoding
 
         Args:
             input (Tensor): of shape (batch, max_seq_len)
             hidden (Tensor): of shape (batch, hidden)
             encoder_outs (Tensor): of shape (batch, seq, hidden)
+            encoder_mask (Tensor, optional): of shape (batch, seq), False for padding
+                positions which should get no attention.
 
         Returns:
             out: all outputs (batch, output)
             hidden: last hidden state
             attn: the attention values
         """
+        full_ctx, hidden, attn = self.decode(
+            input, hidden, encoder_outs, input_lengths, encoder_mask
+        )
+        return self.log_probs(full_ctx), hidden, attn
+
+    def log_probs(self, full_ctx):
+        """Exact log-probabilities over the whole vocabulary, (batch, seq, output)"""
+        with record_function("output_layer"):
+            return self._log_probs(full_ctx)
+
+    def _log_probs(self, full_ctx):
+        if self.adaptive is None:
+            return self.logsoftmax(self.mlp(full_ctx).float())
 
+        batch, seq, _ = full_ctx.size()
+        out = self.adaptive.log_prob(full_ctx.reshape(batch * seq, -1)).float()
+        out = out.index_select(1, self.idx2rank)
+        return out.reshape(batch, seq, -1)
+
+    def loss(self, input, hidden, encoder_outs, input_lengths, targets, criterion):
+        """Training loss. With the adaptive softmax the full distribution is never
+        computed, `criterion` is only used for the dense output layer.
+
+        Returns:
+            loss: scalar loss
+            hidden: last hidden state
+            attn: the attention values
+        """
+        full_ctx, hidden, attn = self.decode(
+            input, hidden, encoder_outs, input_lengths
+        )
+        with record_function("loss"):
+            if self.adaptive is None:
+                out = self.logsoftmax(self.mlp(full_ctx).float())
+                return criterion(out.permute(0, 2, 1), targets), hidden, attn
+
+            mask = targets != 0  # <pad>
+            ranks = self.idx2rank[targets[mask]]
+            with without_autocast(full_ctx.device):
+                loss = self.adaptive(full_ctx[mask].float(), ranks).loss
+            return loss, hidden, attn
+
+    def decode(
+        self, input, hidden, encoder_outs, input_lengths=None, encoder_mask=None
+    ):
+        """Runs the GRU and attention, returns the input to the output layer."""
         target_len = input.size(1)
 
         embeddings = self.embedding(input)  # (batch, seq_len, hidden_dim)
         embeddings = self.emb_drop(embeddings)  # (batch, seq_len, hidden_dim)
         embeddings = F.relu(embeddings)  # (batch, seq_len, hidden_dim)
+        hidden = hidden.float()  # the GRU runs in fp32, see TermDecoder
         embeddings = torch.nn.utils.rnn.pack_padded_sequence(
             embeddings, input_lengths, batch_first=True, enforce_sorted=False
         )  # (batch, seq_len, hidden_dim)
 
-        out, hidden = self.gru(embeddings, hidden)  # ()
+        with record_function("language_decoder"):
+            out, hidden = self.gru(embeddings, hidden)  # ()
 
         out, _ = torch.nn.utils.rnn.pad_packed_sequence(
             out, batch_first=True, total_length=target_len
         )  # (batch, seq_len, hidden_dim)
 
-        out_proj = self.att_mlp(out)  # (batch, seq, hidden)
-        enc_out_perm = encoder_outs.permute(0, 2, 1)  # (batch, hidden, seq)
-        e_exp = torch.bmm(out_proj, enc_out_perm)
-        attn = self.attn_softmax(e_exp)
+        with record_function("attention"):
+            out_proj = self.att_mlp(out)  # (batch, seq, hidden)
+            enc_out_perm = encoder_outs.permute(0, 2, 1)  # (batch, hidden, seq)
+            e_exp = torch.bmm(out_proj, enc_out_perm)
+            if encoder_mask is not None:
+                e_exp = e_exp.masked_fill(~encoder_mask.unsqueeze(1), float("-inf"))
+            attn = self.attn_softmax(e_exp)
 
-        ctx = torch.bmm(attn, encoder_outs)
+            ctx = torch.bmm(attn, encoder_outs)
 
         full_ctx = torch.cat([self.gru_drop(out), ctx], dim=2)
-
-        out = self.mlp(full_ctx)
-        out = self.logsoftmax(out)
-        return out, hidden, attn
+        return full_ctx, hidden, attn
 
     def forward_eval(self, encoder_out, encoder_hidden, mapping, max_len=60):
         """Forward in eval mode (without teacher forcing)
@@ -259,34 +484,86 @@ class SentenceDecoderWithAttention(nn.Module):
             max_len (int, optional): The maximum length of the generated caption.
                 Defaults to 60.
         """
+        words_decoded = ["<start>"]
+        confidence = [1]
 
+        for word, conf in self.iter_eval(encoder_out, encoder_hidden, mapping, max_len):
+            words_decoded.append(word)
+            confidence.append(conf)
+
+        return words_decoded, confidence
+
+    @torch.no_grad()
+    def iter_eval(self, encoder_out, encoder_hidden, mapping, max_len=60):
+        """Generator version of forward_eval, yields (word, confidence) as soon as
+        each word is decoded, the last one being <end> (unless max_len is reached).
+        Closing the generator stops the decoding.
+        """
         batch_size = encoder_out.size(0)
         assert batch_size == 1
 
         start = mapping["<start>"]
 
-        words_decoded = [start]
-        confidence = [1]
-
         device = list(self.parameters())[0].device
 
         last_word_decoded = torch.tensor([start]).reshape((1, 1)).to(device=device)
         cap_len = torch.tensor([1]).to(device=device, dtype=torch.long)
 
         for _ in range(1, max_len + 1):
-            out_dec, encoder_hidden, attn = self(
-                last_word_decoded, encoder_hidden, encoder_out, input_lengths=cap_len
-            )
+            with record_function("decoder_step"):
+                out_dec, encoder_hidden, attn = self(
+                    last_word_decoded,
+                    encoder_hidden,
+                    encoder_out,
+                    input_lengths=cap_len,
+                )
 
             topv, topi = out_dec.topk(1)  # (batch_size, 1, 1)
-            topv, topi = out_dec.topk(1)  # (batch_size, 1, 1)
-            words_decoded.append(topi.item())
-            confidence.append(torch.exp(topv).item())
+            yield mapping[topi.item()], torch.exp(topv).item()
             if topi.item() == mapping["<end>"]:
                 break
             last_word_decoded = topi.reshape((1, 1)).detach()
 
-        return list(mapping.decode(words_decoded)), confidence
+    def forward_eval_batch(
+        self, encoder_out, encoder_hidden, mapping, max_len=60, encoder_mask=None
+    ):
+        """Batched version of forward_eval. Decoding stops once every caption in
+        the batch has reached <end>.
+
+        Args:
+            encoder_mask (Tensor, optional): of size (batch, seq), False for the
+                padding positions of encoder_out.
+
+        Returns:
+            list(tuple(list, list)): caption and confidences for each batch element
+        """
+        batch_size = encoder_out.size(0)
+        start, end = mapping["<start>"], mapping["<end>"]
+
+        device = list(self.parameters())[0].device
+
+        last_words = torch.full((batch_size, 1), start, dtype=torch.long, device=device)
+        cap_len = torch.ones(batch_size, dtype=torch.long)
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+
+        words_decoded = [last_words]
+        confidence = [torch.ones(batch_size, 1, device=device)]
+
+        for _ in range(1, max_len + 1):
+            with record_function("decoder_step"):
+                out_dec, encoder_hidden, attn = self(
+                    last_words, encoder_hidden, encoder_out, cap_len, encoder_mask
+                )
+            topv, topi = out_dec.topk(1)  # (batch_size, 1, 1)
+            last_words = topi.squeeze(2).detach()  # (batch_size, 1)
+            words_decoded.append(last_words)
+            confidence.append(torch.exp(topv.squeeze(2)))
+
+            finished |= last_words.squeeze(1) == end
+            if finished.all():
+                break
+
+        return split_decoded(words_decoded, confidence, mapping)
 
 
 class LanguageGenerator(nn.Module):
@@ -302,13 +579,53 @@ class LanguageGenerator(nn.Module):
         hidden = torch.cat([hidden[0, :, :], hidden[1, :, :]], dim=1).unsqueeze(0)
         return self.dec(encoded_captions, hidden, out, encoded_lengths)
 
-    def forward_eval(self, terms, terms_lengths, mapping):
+    def loss(
+        self,
+        terms,
+        terms_lengths,
+        encoded_captions,
+        encoded_lengths,
+        targets,
+        criterion,
+    ):
+        out, hidden, lens = self.enc(
+            terms, self.enc.init_hidden(terms.size(0)), terms_lengths
+        )
+        hidden = torch.cat([hidden[0, :, :], hidden[1, :, :]], dim=1).unsqueeze(0)
+        return self.dec.loss(
+            encoded_captions, hidden, out, encoded_lengths, targets, criterion
+        )
+
+    def forward_eval(self, terms, terms_lengths, mapping, max_len=60):
         out, hidden, out_len = self.enc(
             terms, self.enc.init_hidden(terms.size(0)), terms_lengths
         )
         hidden = torch.cat([hidden[0, :, :], hidden[1, :, :]], dim=1).unsqueeze(0)
         out = out[:, : out_len.item(), :]
-        return self.dec.forward_eval(out, hidden, mapping)
+        return self.dec.forward_eval(out, hidden, mapping, max_len=max_len)
+
+    @torch.no_grad()
+    def iter_eval(self, terms, terms_lengths, mapping, max_len=60):
+        """Generator version of forward_eval, see SentenceDecoderWithAttention."""
+        out, hidden, out_len = self.enc(
+            terms, self.enc.init_hidden(terms.size(0)), terms_lengths
+        )
+        hidden = torch.cat([hidden[0, :, :], hidden[1, :, :]], dim=1).unsqueeze(0)
+        out = out[:, : out_len.item(), :]
+        yield from self.dec.iter_eval(out, hidden, mapping, max_len=max_len)
+
+    def forward_eval_batch(self, terms, terms_lengths, mapping, max_len=60):
+        """Batched forward_eval, padding terms are masked out of the attention."""
+        out, hidden, out_len = self.enc(
+            terms, self.enc.init_hidden(terms.size(0)), terms_lengths
+        )
+        hidden = torch.cat([hidden[0, :, :], hidden[1, :, :]], dim=1).unsqueeze(0)
+        seq_len = out_len.max().item()
+        out = out[:, :seq_len, :]
+        mask = torch.arange(seq_len).unsqueeze(0) < out_len.unsqueeze(1)
+        return self.dec.forward_eval_batch(
+            out, hidden, mapping, max_len=max_len, encoder_mask=mask.to(out.device)
+        )
 
 
 # TODO avoid duplication
@@ -319,26 +636,230 @@ def extract_caption_len(captions):
 
 
 class SemStyle(nn.Module):
-    def __init__(self, img_to_term, language_generator, mmap, tmap, cmap):
+    def __init__(
+        self,
+        img_to_term,
+        language_generator,
+        mmap,
+        tmap,
+        cmap,
+        caption_cache=None,
+        max_len=60,
+    ):
+        """
+        Args:
+            caption_cache (LRUCache, optional): Memoizes captions of term
+                sequences, keyed by (term ids, style, max_len).
+            max_len (int, optional): The maximum caption length. Defaults to 60.
+        """
         super().__init__()
         self.img_to_term = img_to_term
         self.language_generator = language_generator
         self.mmap = mmap
         self.tmap = tmap
         self.cmap = cmap
+        self.caption_cache = caption_cache
+        self.max_len = max_len
 
-    def forward(self, img, style=None):
-        terms, _ = self.img_to_term(img, self.mmap)
-        terms = terms[1:-1]
-        if not terms:
-            return (terms, [], [])
-        if style:
+        # First stage term ids -> second stage term ids, terms go from one stage
+        # to the other as a gather instead of through their strings
+        self.register_buffer("term_remap", mmap.remap_to(tmap), persistent=False)
+
+    @property
+    def language_device(self):
+        return next(self.language_generator.parameters()).device
+
+    def forward(self, img, style=None, key=None):
+        terms, ((caption, confidence),) = self.forward_styles(img, [style], key)
+        if terms and style:
             terms = terms + [style]
-        orig_terms = list(terms)
-        terms = self.tmap.prepare_for_training(terms, max_caption_len=20, terms=True)
-        terms = torch.LongTensor(terms).unsqueeze(0)
-        terms, tlens = extract_caption_len(terms)
-        return (
-            orig_terms,
-            *self.language_generator.forward_eval(terms, tlens, self.cmap),
+        return terms, caption, confidence
+
+    def forward_styles(self, img, styles, key=None):
+        """Captions a single image in several styles. Image features and terms are
+        computed once, the captions for all styles are decoded as one batch.
+
+        Args:
+            img (Tensor): of shape (1, 3, H, W)
+            styles (list): e.g. [None, "<shake_orig>", "<shake_modern>"]
+            key (str, optional): Cache key of the image, see ImgToTermNet.
+
+        Returns:
+            tuple(list, list): the terms and a (caption, confidence) pair per style
+        """
+        return self.forward_batch([img], [styles], [key])[0]
+
+    def forward_batch(self, imgs, styles, keys=None):
+        """Captions a list of images, each in its own list of styles. Both stages
+        run batched over all the images (and styles).
+
+        Args:
+            imgs (list): of tensors of shape (1, 3, H, W)
+            styles (list): a list of styles for each image
+            keys (list, optional): Cache keys of the images, see ImgToTermNet.
+
+        Returns:
+            list(tuple(list, list)): the result of forward_styles for each image
+        """
+        with record_function("img_to_term"):
+            results = self.img_to_term.forward_batch(
+                imgs, self.mmap, keys, with_ids=True
+            )
+        terms = [terms[1:-1] for terms, *_ in results]
+        term_ids = self.remap_terms([ids for *_, ids in results])
+        pairs = [
+            (ids, style)
+            for t, ids, img_styles in zip(terms, term_ids, styles)
+            if t
+            for style in img_styles
+        ]
+        with record_function("generate"):
+            captions = iter(self.generate_batch(pairs))
+        return [
+            (t, [next(captions) if t else ([], []) for _ in img_styles])
+            for t, img_styles in zip(terms, styles)
+        ]
+
+    def stream(self, img, style=None, key=None):
+        """Generator yielding the caption word by word, as (word, confidence),
+        without <start>. Closing the generator early frees the compute.
+        """
+        ((terms, _, ids),) = self.img_to_term.forward_batch(
+            [img], self.mmap, [key], with_ids=True
+        )
+        if not terms[1:-1]:
+            return
+
+        encoded, tlens = self.encode_terms(self.remap_terms([ids]), [style])
+        if self.caption_cache is not None:
+            cache_key = self.cache_keys(encoded, tlens, [style])[0]
+            cached = self.caption_cache.get(cache_key)
+            if cached is not None:
+                caption, confidence = cached
+                yield from zip(caption[1:], confidence[1:])
+                return
+
+        caption, confidence = ["<start>"], [1]
+        for word, conf in self.language_generator.iter_eval(
+            encoded, tlens, self.cmap, max_len=self.max_len
+        ):
+            caption.append(word)
+            confidence.append(conf)
+            yield word, conf
+
+        if self.caption_cache is not None:
+            self.caption_cache.put(cache_key, (caption, confidence))
+
+    async def astream(self, img, style=None, key=None, context=nullcontext):
+        """Async iterator version of `stream`. Every decoding step runs in a
+        worker thread, the decoding stops when the consumer stops iterating.
+
+        Args:
+            context (callable, optional): Context manager factory entered around
+                each step in the worker thread, e.g. config.autocast.
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1)
+        generator = self.stream(img, style, key)
+
+        def step():
+            with torch.no_grad(), context():
+                return next(generator, None)
+
+        try:
+            while (item := await loop.run_in_executor(executor, step)) is not None:
+                yield item
+        finally:
+            # Queued after a possibly still running step in the same thread
+            executor.submit(generator.close)
+            executor.shutdown(wait=False)
+
+    def remap_terms(self, term_ids):
+        """First stage term ids (LongTensors) to second stage ones, with a single
+        gather on the language generator's device."""
+        if not term_ids:
+            return []
+        device = self.language_device
+        padded = pad_sequence(term_ids, batch_first=True).to(device)
+        remapped = self.term_remap.to(device)[padded]
+        return [row[: len(ids)] for row, ids in zip(remapped, term_ids)]
+
+    def encode_terms(self, term_ids, styles, max_caption_len=20):
+        """Second stage input: the term ids followed by the style, cut and padded
+        like WordIdxMap.prepare_for_training(..., terms=True) does.
+
+        Args:
+            term_ids (list): 1-D LongTensors of second stage term ids
+            styles (list): a style or None for each element
+
+        Returns:
+            tuple(LongTensor, LongTensor): of sizes (batch, max_caption_len) and
+                (batch, ), the lengths are on the CPU
+        """
+        device = self.language_device
+        max_words = max_caption_len - 2
+        lengths = torch.LongTensor(
+            [
+                min(len(ids) + bool(style), max_words)
+                for ids, style in zip(term_ids, styles)
+            ]
         )
+
+        padded = pad_sequence([ids.to(device) for ids in term_ids], batch_first=True)
+        padded = F.pad(padded, (0, 1))  # room for the style
+        style_ids = [self.tmap[s] if s else self.tmap["<pad>"] for s in styles]
+        n_terms = torch.LongTensor([len(ids) for ids in term_ids]).to(device)
+        padded.scatter_(
+            1, n_terms.unsqueeze(1), torch.tensor(style_ids, device=device).unsqueeze(1)
+        )
+
+        padded = padded[:, :max_words]
+        return F.pad(padded, (0, max_caption_len - padded.size(1))), lengths
+
+    def cache_keys(self, encoded, lengths, styles):
+        return [
+            (tuple(row[:length]), style, self.max_len)
+            for row, length, style in zip(encoded.tolist(), lengths.tolist(), styles)
+        ]
+
+    def generate(self, terms, styles):
+        """Second stage: captions the same terms in each of the styles.
+
+        Returns:
+            list(tuple(list, list)): (caption, confidence) per style
+        """
+        ids = torch.LongTensor(list(self.tmap.encode(terms)))
+        return self.generate_batch([(ids, style) for style in styles])
+
+    def generate_batch(self, pairs):
+        """Second stage for a list of (term ids, style) pairs, the ids being a
+        LongTensor in the `tmap` vocabulary. Only the captions missing from
+        `caption_cache` are decoded, as one batch.
+
+        Returns:
+            list(tuple(list, list)): (caption, confidence) per pair
+        """
+        if not pairs:
+            return []
+
+        term_ids, styles = zip(*pairs)
+        encoded, tlens = self.encode_terms(term_ids, styles)
+
+        if self.caption_cache is None:
+            results = [None] * len(pairs)
+        else:
+            keys = self.cache_keys(encoded, tlens, styles)
+            results = [self.caption_cache.get(k) for k in keys]
+
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            if len(missing) < len(pairs):
+                encoded, tlens = encoded[missing], tlens[missing]
+            decoded = self.language_generator.forward_eval_batch(
+                encoded, tlens, self.cmap, max_len=self.max_len
+            )
+            for i, result in zip(missing, decoded):
+                results[i] = result
+                if self.caption_cache is not None:
+                    self.caption_cache.put(keys[i], result)
+        return results
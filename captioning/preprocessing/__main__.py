@@ -1,7 +1,18 @@
+from ..config import computed_path, parse_args
+from . import accounting
+from .accounting import step
 from .feature_extraction import main as extract_features
 from .to_final import main as to_final
 from .to_frames import main as to_frames
 
-to_frames()
-to_final()
-extract_features()
+parse_args()
+accounting.start(computed_path / "preprocessing_report.json")
+try:
+    with step("to_frames"):
+        to_frames()
+    with step("to_final"):
+        to_final()
+    with step("extract_features"):
+        extract_features()
+finally:
+    accounting.print_summary()
@@ -0,0 +1,167 @@
+"""Wall time and peak memory of the preprocessing steps, to tell which one runs out
+of memory.
+
+Steps nest: `python -m captioning.preprocessing` runs to_frames, to_final and
+extract_features, which are made of steps such as make_coco_basic, match,
+reduce_frames or populate_file. Peak RSS is the kernel's high water mark, reset
+at the start of each step (Linux, elsewhere it's the peak since the process
+started). Once `start` was called, steps also get the peak of the Python
+allocations (tracemalloc) and the source lines holding the most memory, at
+`mark()` or at the end of the step. The report is rewritten after every step,
+so it survives the OOM killer: steps still "running" in it are the suspects.
+
+Before Python 3.9 the tracemalloc peak can't be reset, the traces are cleared
+instead: the top allocations then only cover what each step allocated, and
+memory the step freed from earlier ones is still counted in its peak.
+"""
+import functools
+import json
+import os
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from ..config import preprocessing_report as settings
+
+records = []
+_running = []
+_report_path = None
+_traced_base = 0  # memory traced before tracemalloc.clear_traces, Python < 3.9
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def start(report_path):
+    """Records the steps to `report_path`, tracing the Python allocations if
+    `preprocessing_report["tracemalloc"]` is on."""
+    global _report_path
+    _report_path = report_path
+    if settings["tracemalloc"]:
+        tracemalloc.start(settings["frames"])
+
+
+def top_allocations():
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]
+    )
+    return [
+        {"where": str(stat.traceback), "bytes": stat.size, "blocks": stat.count}
+        for stat in snapshot.statistics("lineno")[: settings["top"]]
+    ]
+
+
+def mark():
+    """Lists the top allocations of the current step now, e.g. once its data is
+    loaded, rather than at its end when most of it was freed."""
+    if _running and tracemalloc.is_tracing():
+        _running[-1]["top_allocations"] = top_allocations()
+
+
+def reset_peak_traced():
+    global _traced_base
+    if hasattr(tracemalloc, "reset_peak"):
+        tracemalloc.reset_peak()
+    else:
+        _traced_base += tracemalloc.get_traced_memory()[0]
+        tracemalloc.clear_traces()
+
+
+def _update_peaks(record):
+    record["peak_rss"] = max(record["peak_rss"], peak_rss())
+    if tracemalloc.is_tracing():
+        traced = _traced_base + tracemalloc.get_traced_memory()[1]
+        record["peak_traced"] = max(record.get("peak_traced", 0), traced)
+
+
+@contextmanager
+def step(name):
+    if _running:
+        _update_peaks(_running[-1])  # before the high water marks are reset
+    reset_peak_rss()
+    if tracemalloc.is_tracing():
+        reset_peak_traced()
+
+    record = {"name": name, "depth": len(_running), "status": "running"}
+    record["peak_rss"] = 0
+    records.append(record)
+    _running.append(record)
+    write_report()
+
+    start_time = time.perf_counter()
+    try:
+        yield
+        record["status"] = "done"
+    except BaseException:
+        record["status"] = "failed"
+        raise
+    finally:
+        record["wall"] = time.perf_counter() - start_time
+        _update_peaks(record)
+        if tracemalloc.is_tracing() and "top_allocations" not in record:
+            record["top_allocations"] = top_allocations()
+        _running.pop()
+        if _running:
+            parent = _running[-1]
+            parent["peak_rss"] = max(parent["peak_rss"], record["peak_rss"])
+            if "peak_traced" in record:
+                parent["peak_traced"] = max(
+                    parent.get("peak_traced", 0), record["peak_traced"]
+                )
+        write_report()
+
+
+def accounted(func):
+    """Runs `func` as a step, named after it and its first path (or file)
+    argument."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        name = func.__name__
+        paths = [getattr(a, "filename", a) for a in args]
+        paths = [a for a in paths if isinstance(a, (str, os.PathLike))]
+        if paths:
+            name = f"{name} {os.path.basename(paths[0])}"
+        with step(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def write_report():
+    if _report_path is None:
+        return
+    tmp_path = f"{_report_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(records, f, indent=2)
+    os.replace(tmp_path, _report_path)
+
+
+def print_summary():
+    print(f"{'step':<48} {'wall s':>9} {'peak RSS MiB':>13} {'peak py MiB':>12}")
+    for record in records:
+        name = "  " * record["depth"] + record["name"]
+        traced = record.get("peak_traced")
+        traced = f"{traced / 2 ** 20:>12.0f}" if traced is not None else f"{'-':>12}"
+        print(
+            f"{name:<48.48} {record.get('wall', 0):>9.1f} "
+            f"{record['peak_rss'] / 2 ** 20:>13.0f} {traced}"
+            + ("" if record["status"] == "done" else f"  {record['status']}")
+        )
@@ -1,19 +1,66 @@
+import time
+from collections import defaultdict
 from pathlib import Path
 
 import h5py
 import numpy as np
 import torch
+from torch.utils.data import DataLoader, Subset
 from tqdm.auto import tqdm
 
-from ..config import coco_captions_train, coco_captions_val, device
+from .. import config
+from ..config import (
+    coco_captions_train,
+    coco_captions_val,
+    feature_extraction,
+    parse_args,
+)
 from ..model import FeatureExtractor
 from ..utils import ask_overwrite
+from .accounting import accounted
 
 
-def populate_file(f, dataset):
+def get_model():
     model = FeatureExtractor()
     model.eval()
-    model.to(device)
+    return model.to(config.device)
+
+
+def forward_by_size(model, imgs):
+    """Features of images of different sizes, the ones of the same size are
+    computed together."""
+    feats = [None] * len(imgs)
+    by_size = defaultdict(list)
+    for i, img in enumerate(imgs):
+        by_size[img.shape].append(i)
+    for indices in by_size.values():
+        batch = torch.stack([imgs[i] for i in indices]).to(config.device)
+        for i, feat in zip(indices, model(batch).cpu()):
+            feats[i] = feat
+    return torch.stack(feats).numpy()
+
+
+def images_only(batch):
+    return [img for img, _ in batch]  # the images differ in size
+
+
+def compute_features(model, dataset):
+    """Yields the features of `dataset`, in order, a batch at a time. The images
+    are decoded by the DataLoader workers."""
+    dataloader = DataLoader(
+        dataset,
+        batch_size=feature_extraction["batch_size"],
+        num_workers=feature_extraction["num_workers"],
+        collate_fn=images_only,
+    )
+    with torch.no_grad():
+        for imgs in tqdm(dataloader, desc="Computing Features"):
+            yield forward_by_size(model, imgs)
+
+
+@accounted
+def populate_file(f, dataset):
+    model = get_model()
 
     feature_shape = (len(dataset), model.out_features)
     features = f.create_dataset("features", feature_shape, dtype="f")
@@ -22,11 +69,10 @@ def populate_file(f, dataset):
     h5py_ids = f.create_dataset("ids", (len(dataset),), dtype="i")
     h5py_ids[...] = ids
 
-    with torch.no_grad():
-        for i, (img, _) in enumerate(tqdm(dataset, desc="Computing Features")):
-            img = img.unsqueeze(0).to(device)
-            feats = model(img).cpu().numpy()
-            features[i] = feats[0]
+    start = 0
+    for feats in compute_features(model, dataset):
+        features[start : start + len(feats)] = feats
+        start += len(feats)
 
 
 def extract(dataset, conf):
@@ -41,9 +87,24 @@ def extract(dataset, conf):
 
 
 def main():
+    if feature_extraction["threads"]:
+        torch.set_num_threads(feature_extraction["threads"])
     for dataset, conf in (coco_captions_train(), coco_captions_val()):
         extract(dataset, conf)
 
 
+def benchmark(n):
+    """Computes the features of `n` validation images. Returns `n` and the
+    seconds it took, loading the model excluded."""
+    dataset, _ = coco_captions_val()
+    model = get_model()
+
+    start = time.perf_counter()
+    for _ in compute_features(model, Subset(dataset, range(n))):
+        pass
+    return n, time.perf_counter() - start
+
+
 if __name__ == "__main__":
+    parse_args()
     main()
@@ -7,10 +7,15 @@ from operator import itemgetter
 import networkx as nx
 from tqdm.auto import tqdm
 
-from ..config import coco_train_conf, coco_val_conf, load_framenet, shakespare_conf
+from ..config import (
+    coco_train_conf,
+    coco_val_conf,
+    load_framenet,
+    parse_args,
+    shakespare_conf,
+)
 from ..utils import ask_overwrite
-
-fn = load_framenet()
+from .accounting import accounted, mark
 
 
 def to_words(caption):
@@ -28,6 +33,7 @@ def extract_frames(annotations):
 
 
 def get_framenet_graph():
+    fn = load_framenet()
 
     # create graph nodes
     dg = nx.DiGraph()
@@ -87,6 +93,7 @@ def compress_framenet_graph(frame_graph, th=200):
     return parent_graph
 
 
+@accounted
 def get_frame_mapping(coco_frames):
     """Should return map(Frame.name, Frame.name).
     All keys should be replaced by values in the final version"""
@@ -100,6 +107,7 @@ def new_terms(fmap, terms):
     return [(term if term not in fmap else fmap[term]) for term in terms]
 
 
+@accounted
 def reduce_frames(frame_path, out_path, fmap):
     if not ask_overwrite(out_path):
         return
@@ -120,6 +128,7 @@ def reduce_frames(frame_path, out_path, fmap):
         new_anns = [
             {**ann, "original_words": to_words(ann["original"])} for ann in new_anns
         ]
+    mark()
 
     with open(out_path, "wt") as f:
         json.dump(new_anns, f, indent=2)
@@ -140,4 +149,5 @@ def main():
 
 
 if __name__ == "__main__":
+    parse_args()
     main()
@@ -11,9 +11,11 @@ from ..config import (
     coco_train_conf,
     coco_val_conf,
     get_zipped_plays_paths,
+    parse_args,
     shakespare_conf,
 )
 from ..utils import ask_overwrite
+from .accounting import accounted, mark
 
 
 def cap_to_ascii(cap):
@@ -22,6 +24,7 @@ def cap_to_ascii(cap):
     return cap.replace("\n", " ")
 
 
+@accounted
 def make_coco_basic(in_path, out_path):
     if not ask_overwrite(out_path):
         return
@@ -35,12 +38,14 @@ def make_coco_basic(in_path, out_path):
     ]
     # Filtration is needed to work nicely with opensesame
     coco = list(filter(lambda x: not x["caption"][0].isdigit(), coco))
+    mark()
     with open(out_path, "wt") as f:
         json.dump(
             coco, f, indent=2,
         )
 
 
+@accounted
 def make_shake_basic(out_path):
     if not ask_overwrite(out_path):
         return
@@ -54,6 +59,7 @@ def make_shake_basic(out_path):
 
     modern_lines = list(chain.from_iterable(modern_lines))
     old_lines = list(chain.from_iterable(old_lines))
+    mark()
 
     with open(out_path, "wt") as f:
         json.dump(
@@ -68,6 +74,7 @@ def make_shake_basic(out_path):
         )
 
 
+@accounted
 def to_txt(file_in, file_out):
 
     if not ask_overwrite(file_out):
@@ -113,6 +120,7 @@ def extract_terms(all_frames):
     return nouns + verb_frames
 
 
+@accounted
 def match(file_conll, file_in, file_out):
     if not ask_overwrite(file_out):
         return
@@ -144,6 +152,7 @@ def match(file_conll, file_in, file_out):
         {**cap, "terms": sent_to_terms.get(cap["caption"], [])}
         for cap in tqdm(captions, desc="Transforming..")
     ]
+    mark()
 
     with open(file_out, "wt") as f:
         logging.info(f"Saving {file_out}..")
@@ -161,4 +170,5 @@ def main():
 
 
 if __name__ == "__main__":
+    parse_args()
     main()
@@ -18,7 +18,7 @@ from ebooklib import epub
 
 from .to_frames import cap_to_ascii, match
 from .to_final import reduce_frames, get_frame_mapping, extract_frames
-from ..config import tolkien_fldr, tolkien_conf, coco_train_conf
+from ..config import tolkien_fldr, tolkien_conf, coco_train_conf, parse_args
 from ..utils import ask_overwrite
 
 
@@ -91,4 +91,5 @@ def main():
 
 
 if __name__ == "__main__":
+    parse_args()
     main()
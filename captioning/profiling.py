@@ -0,0 +1,72 @@
+"""Opt-in torch.profiler runs, with --profile (or CAPTIONING_PROFILE=1).
+
+The training loops profile a window of steps, the captioning server a window of
+batches: `profiler["wait"]` steps are skipped, `profiler["warmup"]` more are
+profiled and thrown away, then `profiler["active"]` steps are recorded. A Chrome
+trace (open it in chrome://tracing or https://ui.perfetto.dev) and a table of the
+most expensive operators go to experiment_folder/profile_<name>/. The steps are
+split into labeled ranges: the phases of train.instrument, and the encoders,
+decoder steps, attention and loss of the models.
+"""
+import torch
+
+from . import config
+from .config import profiler as settings
+
+
+class NoProfiler:
+    """Stands in for torch.profiler.profile when profiling is off."""
+
+    def start(self):
+        pass
+
+    def step(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+def export(folder):
+    """Writes what a profiler recorded to `folder`."""
+    cuda = torch.cuda.is_available()
+
+    def on_trace_ready(prof):
+        folder.mkdir(parents=True, exist_ok=True)
+        prof.export_chrome_trace(str(folder / f"trace_{prof.step_num}.json"))
+        table = prof.key_averages().table(
+            sort_by="self_cuda_time_total" if cuda else "self_cpu_time_total",
+            row_limit=settings["row_limit"],
+        )
+        (folder / f"operators_{prof.step_num}.txt").write_text(table)
+        print(f"Profile saved to {folder}")
+
+    return on_trace_ready
+
+
+def profile(name):
+    """A profiler to `start()` before the loop, `step()` after each step and
+    `stop()` at the end. A NoProfiler unless --profile is on."""
+    if not config.profile:
+        return NoProfiler()
+    try:
+        from torch.profiler import ProfilerActivity, schedule
+    except ImportError:
+        raise RuntimeError(f"--profile needs torch>=1.8.1, not {torch.__version__}")
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=schedule(
+            wait=settings["wait"],
+            warmup=settings["warmup"],
+            active=settings["active"],
+            repeat=1,
+        ),
+        on_trace_ready=export(config.experiment_folder / f"profile_{name}"),
+        record_shapes=settings["record_shapes"],
+        profile_memory=settings["profile_memory"],
+        with_stack=settings["with_stack"],
+    )
@@ -0,0 +1,65 @@
+"""Post-training int8 quantization for CPU inference.
+
+The GRU and Linear layers are quantized dynamically (int8 weights, activations
+quantized on the fly), the ResNet can additionally be quantized statically after
+calibrating it on a handful of images.
+"""
+from itertools import islice
+
+import torch
+from torch import nn
+from torchvision.models import resnet101
+from torchvision.models.quantization.resnet import (
+    QuantizableBottleneck,
+    QuantizableResNet,
+)
+
+
+def quantize_dynamic(model):
+    """Returns a copy of `model` with int8 GRU and Linear layers. CPU only."""
+    return torch.quantization.quantize_dynamic(
+        model.cpu().eval(), {nn.GRU, nn.Linear}, dtype=torch.qint8
+    )
+
+
+class QuantizableFeatureExtractor(nn.Module):
+    """Drop-in replacement of model.FeatureExtractor that supports static
+    quantization."""
+
+    def __init__(self):
+        super().__init__()
+        self.resnet = QuantizableResNet(QuantizableBottleneck, [3, 4, 23, 3])
+        self.resnet.load_state_dict(resnet101(pretrained=True).state_dict())
+        self.resnet.fc = nn.Sequential()
+        self.resnet.out_features = self.out_features = 2048
+
+    def forward(self, x):
+        return self.resnet(x)
+
+
+def quantize_extractor(images, backend="fbgemm"):
+    """Builds a statically quantized ResNet-101 feature extractor.
+
+    Args:
+        images (iterable): Calibration images, tensors of shape (1, 3, H, W)
+        backend (str, optional): Quantization engine. Defaults to "fbgemm" (x86).
+
+    Returns:
+        QuantizableFeatureExtractor: converted to int8, CPU only
+    """
+    torch.backends.quantized.engine = backend
+    extractor = QuantizableFeatureExtractor().eval()
+    extractor.resnet.fuse_model()
+    extractor.qconfig = torch.quantization.get_default_qconfig(backend)
+    torch.quantization.prepare(extractor, inplace=True)
+
+    with torch.no_grad():
+        for img in images:
+            extractor(img)
+
+    return torch.quantization.convert(extractor, inplace=True)
+
+
+def calibration_images(dataset, n=32, start=0):
+    """`n` images of a CocoCaptions-like dataset, as batches of one."""
+    return (img.unsqueeze(0) for img, _ in islice(dataset, start, start + n))
@@ -3,10 +3,15 @@ from pathlib import Path
 import torch
 from tqdm.auto import tqdm
 
+from .. import config
+from ..bundle import load_bundle
 from ..config import (
-    device,
+    autocast,
+    coco_captions_val,
     first_stage_dataset,
     last_checkpoint_path,
+    parse_args,
+    second_stage,
     second_stage_dataset,
 )
 from ..model import (
@@ -19,9 +24,17 @@ from ..model import (
 )
 from .first_stage import get_image
 
+STYLES = {
+    "none": None,
+    "<shake_orig>": "<shake_orig>",
+    "<shake_modern>": "<shake_modern>",
+}
+
 
 def get_mappings():
-    # TODO get rid of redundant mapping
+    """The first stage term vocabulary, built on different data, differs from the
+    second stage one. SemStyle translates ids between the two with a lookup
+    table, see WordIdxMap.remap_to."""
     dataset = first_stage_dataset()
 
     tmap = dataset.get_term_mapping
@@ -32,40 +45,95 @@ def get_mappings():
     return cmapping, tmap, tmap2
 
 
-def get_models(cmapping, tmapping, tmap2):
+def get_models(cmapping, tmapping, tmap2, quantize=None, cache=None):
+    """Loads the latest checkpoints of both stages.
+
+    Args:
+        quantize (str, optional): One of "none", "dynamic" (int8 GRU and Linear
+            layers) or "static" (additionally an int8 CNN). Quantized models run on
+            the CPU only. Defaults to the -q/--quantize option.
+        cache (LRUCache, optional): Cache for the decoded terms of images.
+    """
+    quantize = quantize or config.quantize
+    device = config.device
+
     dec = TermDecoder(len(tmapping), 2048, 2048)
     dec.load_state_dict(torch.load(last_checkpoint_path(), map_location="cpu"))
-    first_stage = ImgToTermNet(dec)
-    first_stage = first_stage.to(device)
+
+    if quantize == "none":
+        first_stage = ImgToTermNet(dec, cache=cache)
+        first_stage = first_stage.to(device)
+    elif device.type != "cpu":
+        raise RuntimeError(f"Quantized models run on the CPU only, not {device}")
+    else:
+        from ..quantization import (
+            calibration_images,
+            quantize_dynamic,
+            quantize_extractor,
+        )
+
+        extractor = None
+        if quantize == "static":
+            dataset, _ = coco_captions_val()
+            extractor = quantize_extractor(calibration_images(dataset))
+        first_stage = ImgToTermNet(
+            quantize_dynamic(dec), extractor=extractor, cache=cache
+        )
     first_stage = first_stage.eval()
 
     enc = TermEncoder(len(tmap2), 2048)
-    dec = SentenceDecoderWithAttention(len(cmapping), 2048, len(cmapping))
+    dec = SentenceDecoderWithAttention(
+        len(cmapping),
+        2048,
+        len(cmapping),
+        cutoffs=second_stage["adaptive_softmax_cutoffs"],
+    )
 
     lang = LanguageGenerator(enc, dec)
     lang.load_state_dict(torch.load(last_checkpoint_path(2), map_location="cpu"))
     lang.eval()
+    if quantize != "none":
+        lang = quantize_dynamic(lang)
 
     return first_stage, lang
 
 
-def main(img_dir):
+def bundle_path():
+    return config.experiment_folder / "semstyle_bundle.pt"
+
+
+def load_model():
+    """SemStyle from the experiment's bundle if there is one, otherwise from the
+    latest checkpoints. Bundles only support dynamic quantization, -q static
+    raises a ValueError when there is a bundle."""
+    path = bundle_path()
+    if path.exists():
+        if config.quantize == "static":
+            raise ValueError(
+                f"Static quantization needs the checkpoints, not the bundle {path}"
+            )
+        return load_bundle(
+            path, device=config.device, quantize=config.quantize == "dynamic"
+        )
 
-    img_dir = Path(img_dir).expanduser()
-    if not img_dir.is_dir():
-        raise RuntimeError(f"{str(img_dir)} is not a directory!")
     cmap, tmap1, tmap = get_mappings()
     term_gen, lang_gen = get_models(cmap, tmap1, tmap)
+    return SemStyle(term_gen, lang_gen, tmap1, tmap, cmap).eval()
 
-    model = SemStyle(term_gen, lang_gen, tmap1, tmap, cmap)
-    model.eval()
+
+def main(img_dir):
+    img_dir = Path(img_dir).expanduser()
+    if not img_dir.is_dir():
+        raise RuntimeError(f"{str(img_dir)} is not a directory!")
+    model = load_model()
 
     for sub_path in tqdm(sorted(img_dir.iterdir()), desc="Computing captions.."):
         if sub_path.suffix not in (".jpg", ".png"):
             continue
-        terms, cap, _ = model(get_image(sub_path))
-        _, so_cap, _ = model(get_image(sub_path), "<shake_orig>")
-        _, sm_cap, _ = model(get_image(sub_path), "<shake_modern>")
+        with torch.no_grad(), autocast():
+            terms, ((cap, _), (so_cap, _), (sm_cap, _)) = model.forward_styles(
+                get_image(sub_path), [None, "<shake_orig>", "<shake_modern>"]
+            )
 
         print(f"![Sample image](https://students.mimuw.edu.pl/~sm371229/{sub_path})")
         for meat in (
@@ -84,7 +152,11 @@ if __name__ == "__main__":
     import sys
     import select
 
-    print(f"Evaluating {last_checkpoint_path(), last_checkpoint_path(2)}")
+    parse_args()
+    if bundle_path().exists():
+        print(f"Evaluating {bundle_path()}")
+    else:
+        print(f"Evaluating {last_checkpoint_path(), last_checkpoint_path(2)}")
     print("Provide img dir")
     i, _, _ = select.select([sys.stdin], [], [], 15)
     img_dir = sys.stdin.readline().strip() if i else "mini_val"
@@ -0,0 +1,187 @@
+"""Offline captioning of large image collections into a JSONL file.
+
+    python -m captioning.run.bulk images/ -o captions.jsonl --style none
+
+`images/` is searched recursively, a text file is read as a manifest with one image
+path per line, relative to the manifest's folder. Every line of the output holds
+the captions of one image, keyed by its path relative to the directory (or as
+listed in the manifest). Rerunning the same command after an interruption skips
+the images already written.
+"""
+import io
+import json
+import os
+from itertools import islice
+from pathlib import Path
+
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from tqdm.auto import tqdm
+
+from .. import config
+from ..config import autocast, bulk, get_parser, parse_args
+from .__main__ import STYLES, load_model
+
+
+def list_images(source, extensions=None):
+    """Yields (id, path) of the images in a directory tree or a manifest file.
+    `extensions` of the directory tree images default to `bulk["extensions"]`."""
+    extensions = bulk["extensions"] if extensions is None else extensions
+    source = Path(source).expanduser()
+    if source.is_file():
+        with open(source) as f:
+            for line in f:
+                if line.strip():
+                    yield line.strip(), source.parent / Path(line.strip()).expanduser()
+        return
+
+    for root, dirs, files in os.walk(source):
+        dirs.sort()  # deterministic order, os.walk honours in place changes
+        for name in sorted(files):
+            if name.lower().endswith(extensions):
+                path = Path(root) / name
+                yield str(path.relative_to(source)), path
+
+
+def written_ids(output):
+    """Ids already in the output. A line cut short by an interruption is
+    removed."""
+    output = Path(output)
+    if not output.exists():
+        return set()
+
+    ids, good_bytes = set(), 0
+    with open(output, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                ids.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                break
+            good_bytes += len(line)
+
+    if good_bytes < output.stat().st_size:
+        os.truncate(output, good_bytes)
+    return ids
+
+
+class ImageFiles(IterableDataset):
+    """Decodes and transforms the images of `source` not in `done`, in the
+    DataLoader workers, each taking every num_workers-th image. Images which
+    can't be read come out as None, with the error."""
+
+    def __init__(self, source, done):
+        self.source = source
+        self.done = done
+
+    def __iter__(self):
+        images = (i for i in list_images(self.source) if i[0] not in self.done)
+        worker = get_worker_info()
+        if worker is not None:
+            images = islice(images, worker.id, None, worker.num_workers)
+        for img_id, path in images:
+            yield self.load(img_id, path)
+
+    @staticmethod
+    def load(img_id, path):
+        try:
+            img = Image.open(io.BytesIO(Path(path).read_bytes())).convert("RGB")
+            return img_id, config.image_transform(img), None
+        except Exception as e:  # any broken file, PIL raises more than OSError
+            return img_id, None, f"{type(e).__name__}: {e}"
+
+
+def to_records(model, batch, styles):
+    ok = [(img_id, img) for img_id, img, error in batch if error is None]
+    records = {
+        img_id: {"id": img_id, "error": error}
+        for img_id, _, error in batch
+        if error is not None
+    }
+
+    if ok:
+        imgs = [img.unsqueeze(0).to(config.device) for _, img in ok]
+        with torch.no_grad(), autocast():
+            results = model.forward_batch(
+                imgs, [[STYLES[style] for style in styles]] * len(imgs)
+            )
+
+        for (img_id, _), (terms, captions) in zip(ok, results):
+            records[img_id] = {
+                "id": img_id,
+                "terms": terms,
+                "captions": [
+                    {"style": style, "caption": " ".join(cap[1:-1]), "confidence": conf}
+                    for style, (cap, conf) in zip(styles, captions)
+                ],
+            }
+
+    return [records[img_id] for img_id, *_ in batch]
+
+
+def caption_all(
+    model,
+    source,
+    output,
+    styles=("none",),
+    batch_size=None,
+    num_workers=None,
+):
+    """Appends the captions of the images in `source` which are not in `output`
+    yet. Returns the number of images captioned. `batch_size` and `num_workers`
+    default to the `bulk` settings."""
+    batch_size = bulk["batch_size"] if batch_size is None else batch_size
+    num_workers = bulk["num_workers"] if num_workers is None else num_workers
+    done = written_ids(output)
+    if done:
+        print(f"Skipping {len(done)} images already in {output}")
+
+    loader = DataLoader(
+        ImageFiles(source, done),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=list,  # the images differ in size
+    )
+
+    captioned = 0
+    with open(output, "a") as f, tqdm(desc="Captioning", unit="img") as progress:
+        for batch in loader:
+            for record in to_records(model, batch, styles):
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            captioned += len(batch)
+            progress.update(len(batch))
+
+    return captioned
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("source", help="Image directory or manifest file")
+    parser.add_argument("-o", "--output", default="captions.jsonl")
+    parser.add_argument(
+        "-s",
+        "--style",
+        action="append",
+        choices=list(STYLES),
+        help="Can be repeated. Defaults to all the styles",
+    )
+    parser.add_argument("-b", "--batch_size", type=int, help='bulk["batch_size"]')
+    parser.add_argument("-w", "--num_workers", type=int, help='bulk["num_workers"]')
+    args = parse_args(parser=parser)
+
+    n = caption_all(
+        load_model(),
+        args.source,
+        args.output,
+        styles=args.style or list(STYLES),
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+    )
+    print(f"Captioned {n} images into {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Exports the whole SemStyle pipeline, decoding loops included, as a single
+TorchScript artifact. Load it with `captioning.run.exported`.
+
+    python -m captioning.run.export              # the trained models, mini_val
+    python -m captioning.run.export --synthetic  # random weights, random images
+
+--synthetic checks the scripted outputs against eager ones on the random models
+of `bench.synthetic`, with the dense and the adaptive softmax output layers.
+"""
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn.functional as F
+from torch import Tensor, nn
+from tqdm.auto import tqdm
+
+from .. import config
+from ..bench.synthetic import Synthetic
+from ..config import get_parser, parse_args
+from ..model import SemStyle
+from . import exported
+from .__main__ import get_mappings, get_models
+from .first_stage import get_image
+
+
+class ExportableSemStyle(nn.Module):
+    """Scriptable re-implementation of SemStyle.forward sharing the weights of the
+    trained modules. Dropout is skipped, so this is an inference only module.
+
+    Takes an image tensor of shape (1, 3, H, W) with values in [0, 1], as produced
+    by `transforms.ToTensor()`, the normalization is part of the module.
+    """
+
+    term_words: List[str]
+    caption_words: List[str]
+    styles: Dict[str, int]
+    shortlist: int
+    term_start: int
+    term_end: int
+    cap_start: int
+    cap_end: int
+    max_terms: int
+    max_len: int
+
+    def __init__(self, semstyle: SemStyle, max_terms=20):
+        super().__init__()
+        term_decoder = semstyle.img_to_term.term_decoder
+        enc = semstyle.language_generator.enc
+        dec = semstyle.language_generator.dec
+
+        normalize = config.image_transform.transforms[-1]
+        self.register_buffer("mean", torch.tensor(normalize.mean).reshape(1, 3, 1, 1))
+        self.register_buffer("std", torch.tensor(normalize.std).reshape(1, 3, 1, 1))
+        self.resnet = semstyle.img_to_term.extractor.resnet
+
+        self.term_init = term_decoder.init_gru_hidden
+        self.term_embedding = term_decoder.embedding
+        self.term_gru = term_decoder.gru
+        self.term_fc = term_decoder.fc
+
+        self.enc_embedding = enc.embedding
+        self.enc_gru = enc.gru
+        self.enc_hidden = enc.hidden_init_p
+
+        self.dec_embedding = dec.embedding
+        self.dec_gru = dec.gru
+        self.att_mlp = dec.att_mlp
+        # The dense output layer is an adaptive softmax head without clusters
+        if dec.adaptive is None:
+            self.head, self.tails = dec.mlp, nn.ModuleList()
+            self.shortlist = dec.mlp.out_features
+            self.register_buffer("idx2rank", torch.arange(self.shortlist))
+        else:
+            self.head, self.tails = dec.adaptive.head, dec.adaptive.tail
+            self.shortlist = dec.adaptive.shortlist_size
+            self.register_buffer("idx2rank", dec.idx2rank.clone())
+
+        mmap, tmap, cmap = semstyle.mmap, semstyle.tmap, semstyle.cmap
+        self.register_buffer("term_remap", semstyle.term_remap.clone())
+        self.term_words = list(mmap.idx2word)
+        self.caption_words = list(cmap.idx2word)
+        self.styles = {s: tmap[s] for s in ("<shake_modern>", "<shake_orig>")}
+        self.term_start, self.term_end = mmap["<start>"], mmap["<end>"]
+        self.cap_start, self.cap_end = cmap["<start>"], cmap["<end>"]
+        self.max_terms, self.max_len = max_terms, semstyle.max_len
+
+    def decode_terms(self, feats: Tensor) -> List[int]:
+        """Mirrors TermDecoder.forward_eval, returns the ids with <start> and
+        <end>."""
+        hidden = self.term_init(feats).unsqueeze(0)  # (1, 1, hidden)
+        words = [self.term_start]
+        word = torch.full(
+            (1, 1), self.term_start, dtype=torch.long, device=feats.device
+        )
+
+        for _ in range(self.max_terms):
+            emb = F.relu(self.term_embedding(word))
+            out, hidden = self.term_gru(emb, hidden.to(emb.dtype))
+            _, top = F.log_softmax(self.term_fc(out).float(), dim=2).topk(1)
+            words.append(int(top.item()))
+            if words[-1] == self.term_end:
+                break
+            word = top.reshape(1, 1)
+        return words
+
+    def output_log_probs(self, full_ctx: Tensor) -> Tensor:
+        """Mirrors SentenceDecoderWithAttention.log_probs for a (1, 1, 2 * hidden)
+        input, see nn.AdaptiveLogSoftmaxWithLoss.log_prob."""
+        x = full_ctx.reshape(1, -1)
+        head = F.log_softmax(self.head(x).float(), dim=1)
+        log_probs = [head[:, : self.shortlist]]
+        cluster = self.shortlist
+        for tail in self.tails:
+            cluster_log_probs = F.log_softmax(tail(x).float(), dim=1)
+            log_probs.append(cluster_log_probs + head[:, cluster].unsqueeze(1))
+            cluster += 1
+        out = torch.cat(log_probs, dim=1).index_select(1, self.idx2rank)
+        return out.unsqueeze(0)
+
+    def decode_caption(self, terms: Tensor) -> Tuple[List[int], List[float]]:
+        """Mirrors LanguageGenerator.forward_eval for a (1, seq) tensor of terms."""
+        emb = F.relu(self.enc_embedding(terms)).transpose(0, 1)  # (seq, 1, hidden)
+        enc_out, enc_hidden = self.enc_gru(emb, self.enc_hidden)
+        enc_out = enc_out.transpose(0, 1)  # (1, seq, hidden)
+        hidden = torch.cat([enc_hidden[0], enc_hidden[1]], dim=1).unsqueeze(0)
+
+        words = [self.cap_start]
+        confidence = [1.0]
+        word = torch.full((1, 1), self.cap_start, dtype=torch.long, device=terms.device)
+
+        for _ in range(self.max_len):
+            emb = F.relu(self.dec_embedding(word))
+            out, hidden = self.dec_gru(emb, hidden.to(emb.dtype))
+            attn = torch.bmm(self.att_mlp(out), enc_out.permute(0, 2, 1))
+            ctx = torch.bmm(F.softmax(attn, dim=2), enc_out)
+            log_probs = self.output_log_probs(torch.cat([out, ctx], dim=2))
+            top_v, top = log_probs.topk(1)
+            words.append(int(top.item()))
+            confidence.append(float(torch.exp(top_v).item()))
+            if words[-1] == self.cap_end:
+                break
+            word = top.reshape(1, 1)
+        return words, confidence
+
+    def forward(
+        self, img: Tensor, style: str = ""
+    ) -> Tuple[List[str], List[str], List[float]]:
+        feats = self.resnet((img - self.mean) / self.std)
+        term_ids = self.decode_terms(feats)[1:-1]
+        terms = [self.term_words[i] for i in term_ids]
+        if len(term_ids) == 0:
+            no_words: List[str] = []
+            no_confidence: List[float] = []
+            return terms, no_words, no_confidence
+
+        ids = self.term_remap[torch.tensor(term_ids, device=img.device)]
+        if style != "":
+            style_id = torch.tensor([self.styles[style]], device=img.device)
+            ids = torch.cat([ids, style_id])
+            terms.append(style)
+        # Same truncation as WordIdxMap.prepare_for_training(max_caption_len=20)
+        ids = ids[:18].unsqueeze(0)
+
+        words, confidence = self.decode_caption(ids)
+        return terms, [self.caption_words[i] for i in words], confidence
+
+
+def export(model, path):
+    scripted = torch.jit.script(ExportableSemStyle(model).eval())
+    scripted.save(str(path))
+    return scripted
+
+
+def same_outputs(eager, scripted):
+    terms, cap, conf = eager
+    s_terms, s_cap, s_conf = scripted
+    return (
+        terms == s_terms
+        and cap == s_cap
+        and torch.allclose(torch.tensor(conf), torch.tensor(s_conf))
+    )
+
+
+def check_parity(model, scripted, img_paths, styles=(None, "<shake_orig>")):
+    """Compares eager and exported outputs, returns the number of mismatches."""
+    mismatches = 0
+    with torch.no_grad():
+        for img_path in tqdm(img_paths, desc="Checking parity"):
+            img = exported.load_image(img_path)
+            for style in styles:
+                eager = model(get_image(img_path).cpu(), style)
+                s_out = scripted(img, style or "")
+                if not same_outputs(eager, s_out):
+                    mismatches += 1
+                    print(f"Mismatch for {img_path}, {style}: {eager[1]} vs {s_out[1]}")
+    return mismatches
+
+
+def check_synthetic_parity(images=3, styles=(None, "<shake_orig>"), seed=0):
+    """check_parity on random images and the random models of Synthetic, with
+    the dense output layer and the adaptive softmax. Returns the number of
+    mismatches."""
+    normalize = config.image_transform.transforms[-1]
+    data = Synthetic(seed=seed)
+    vocabulary = len(data.second_stage_dataset.get_cap_mapping)
+    mismatches = 0
+    try:
+        for cutoffs in (None, [vocabulary // 10, vocabulary // 2]):
+            model = data.make_semstyle(data.make_language_generator(cutoffs))
+            scripted = torch.jit.script(ExportableSemStyle(model).eval())
+            with torch.no_grad():
+                for i in range(images):
+                    img = torch.rand(1, 3, 224, 224)
+                    for style in styles:
+                        eager = model(normalize(img[0]).unsqueeze(0), style)
+                        s_out = scripted(img, style or "")
+                        if not same_outputs(eager, s_out):
+                            mismatches += 1
+                            print(f"Mismatch, cutoffs {cutoffs}, image {i}, {style}")
+    finally:
+        data.close()
+    print(f"{mismatches} mismatches out of {2 * images * len(styles)} captions")
+    return mismatches
+
+
+def main(img_dir="mini_val"):
+    cmap, tmap1, tmap = get_mappings()
+    term_gen, lang_gen = get_models(cmap, tmap1, tmap)
+    model = SemStyle(term_gen, lang_gen, tmap1, tmap, cmap).cpu().eval()
+
+    path = config.experiment_folder / "semstyle_scripted.pt"
+    scripted = export(model, path)
+    print(f"Exported to {path}")
+
+    img_paths = [
+        p for p in sorted(Path(img_dir).iterdir()) if p.suffix in (".jpg", ".png")
+    ]
+    mismatches = check_parity(model, scripted, img_paths)
+    print(f"{mismatches} mismatches out of {2 * len(img_paths)} captions")
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument(
+        "--synthetic", action="store_true", help="check random models instead"
+    )
+    args = parse_args(parser=parser)
+    if args.synthetic:
+        raise SystemExit(check_synthetic_parity() > 0)
+    main()
@@ -0,0 +1,40 @@
+"""Runs a SemStyle model exported with `python -m captioning.run.export`.
+
+Deliberately independent of `captioning.config` and the datasets, so it can be used
+wherever torch, torchvision and PIL are available.
+
+Example:
+    model = load("runs/exp_000/semstyle_scripted.pt")
+    terms, caption, confidence = caption_image(model, "img.jpg", "<shake_orig>")
+"""
+import torch
+from PIL import Image
+from torchvision.transforms import transforms
+
+# Normalization is a part of the exported model
+_transform = transforms.Compose([transforms.Resize(256), transforms.ToTensor()])
+
+
+def load(path, device="cpu"):
+    return torch.jit.load(str(path), map_location=device).eval()
+
+
+def load_image(img_path, device="cpu"):
+    img = Image.open(img_path)
+    return _transform(img).unsqueeze(0).to(device)
+
+
+def caption_image(model, img_path, style=None):
+    """
+    Args:
+        model (ScriptModule): The result of `load`
+        img_path (str): Path to the image
+        style (str, optional): "<shake_orig>", "<shake_modern>" or None
+
+    Returns:
+        tuple(list, list, list): terms, caption with <start> and <end> tokens,
+            confidence of each caption token
+    """
+    device = next(model.buffers()).device
+    with torch.no_grad():
+        return model(load_image(img_path, device), style or "")
@@ -3,18 +3,19 @@ from pathlib import Path
 import torch
 from PIL import Image
 
-from ..config import device, first_stage_dataset, image_transform, last_checkpoint_path
+from .. import config
+from ..config import autocast, first_stage_dataset, last_checkpoint_path, parse_args
 from ..model import ImgToTermNet, TermDecoder
 
 
 def get_image(img_path):
     img = Image.open(img_path)
-    img = image_transform(img)
-    return img.to(device).unsqueeze(0)
+    img = config.image_transform(img)
+    return img.to(config.device).unsqueeze(0)
 
 
 def run_path(model, mapping, img_path):
-    with torch.no_grad():
+    with torch.no_grad(), autocast():
         terms, _ = model(get_image(img_path), mapping)
         return terms
 
@@ -27,7 +28,7 @@ def main():
     dec = TermDecoder(vocab_size, 2048, 2048)
     dec.load_state_dict(torch.load(last_checkpoint_path(), map_location="cpu"))
     model = ImgToTermNet(dec)
-    model = model.to(device)
+    model = model.to(config.device)
     model = model.eval()
 
     try:
@@ -57,4 +58,5 @@ def main():
 
 
 if __name__ == "__main__":
+    parse_args()
     main()
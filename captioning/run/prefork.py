@@ -0,0 +1,148 @@
+"""Multi-process captioning service sharing a single copy of the weights.
+
+The parent loads SemStyle once, memory-mapped from the experiment's bundle when
+there is one (`python -m captioning.bundle`) and torch >= 2.1, otherwise into
+shared memory, and forks `config.server["workers"]` copies of
+`captioning.run.server` listening on the same port. The workers only read the
+weights, so the pages stay shared, and each uses cpu_count / workers intra-op
+threads. Each keeps its own caches.
+
+    python -m captioning.run.prefork
+    python -m captioning.run.prefork --measure 1 2 4 8  # memory use per worker count
+
+CPU only, Linux only for --measure. No inference runs in the parent, as forking
+after OpenMP started its thread pool can deadlock the workers.
+"""
+import multiprocessing
+import os
+
+import torch
+from aiohttp import web
+
+from .. import config
+from ..bundle import load_bundle, mmap_supported
+from ..cache import LRUCache, nbytes
+from ..config import get_parser, parse_args, server
+from ..model import SemStyle
+from .__main__ import bundle_path, get_mappings, get_models
+from .server import make_app
+
+
+def load_shared_model():
+    path = bundle_path()
+    if path.exists():
+        if not mmap_supported():
+            return load_bundle(path).share_memory()
+        # Backed by the page cache, shared between processes as is
+        return load_bundle(path, mmap=True)
+
+    cmap, tmap1, tmap = get_mappings()
+    term_gen, lang_gen = get_models(cmap, tmap1, tmap)
+    model = SemStyle(term_gen, lang_gen, tmap1, tmap, cmap).eval()
+    return model.share_memory()
+
+
+def threads_per_worker(workers):
+    return server["threads_per_worker"] or max(1, os.cpu_count() // workers)
+
+
+def setup_worker(model, threads):
+    torch.set_num_threads(threads)
+    model.img_to_term.cache = LRUCache(server["image_cache_bytes"], sizeof=nbytes)
+    model.caption_cache = LRUCache(server["caption_cache_entries"])
+
+
+def serve(model, threads):
+    setup_worker(model, threads)
+    web.run_app(
+        make_app(model),
+        host=server["host"],
+        port=server["port"],
+        reuse_port=True,
+        print=None,
+    )
+
+
+def run_workers(model, workers, target=serve, args=()):
+    ctx = multiprocessing.get_context("fork")
+    threads = threads_per_worker(workers)
+    processes = [
+        ctx.Process(target=target, args=(model, threads, *args), daemon=True)
+        for _ in range(workers)
+    ]
+    for p in processes:
+        p.start()
+    return processes
+
+
+def memory_usage(pid="self"):
+    """Resident (RSS) and proportional (PSS, shared pages split between the
+    processes mapping them) set sizes in bytes."""
+    usage = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, value, *_ = line.split()
+            if name in ("Rss:", "Pss:"):
+                usage[name[:-1].lower()] = int(value) * 1024
+    return usage
+
+
+def _idle(model, threads, ready, stop):
+    setup_worker(model, threads)
+    with torch.no_grad():  # touch all the weights and allocate the activations
+        model.forward_batch([torch.rand(1, 3, 256, 256)], [[None]])
+    ready.release()
+    stop.wait()
+
+
+def measure(model, worker_counts):
+    """Prints the memory used by the parent and its workers, after each worker
+    captioned an image."""
+    ctx = multiprocessing.get_context("fork")
+    print(f"{'workers':>8} {'RSS sum MiB':>12} {'PSS sum MiB':>12} {'PSS/worker':>11}")
+    for workers in worker_counts:
+        ready, stop = ctx.Semaphore(0), ctx.Event()
+        processes = run_workers(model, workers, _idle, (ready, stop))
+        for _ in processes:
+            ready.acquire()
+
+        usage = [memory_usage()] + [memory_usage(p.pid) for p in processes]
+        rss = sum(u["rss"] for u in usage) / 2 ** 20
+        pss = sum(u["pss"] for u in usage) / 2 ** 20
+        print(f"{workers:>8} {rss:>12.0f} {pss:>12.0f} {pss / workers:>11.0f}")
+
+        stop.set()
+        for p in processes:
+            p.join()
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("-w", "--workers", type=int, help='server["workers"]')
+    parser.add_argument("--measure", type=int, nargs="+", metavar="WORKERS")
+    args = parse_args(parser=parser)
+
+    if config.device.type != "cpu":
+        raise RuntimeError("Forked workers run on the CPU only")
+
+    model = load_shared_model()
+    if args.measure:
+        measure(model, args.measure)
+        return
+
+    workers = args.workers or server["workers"]
+    processes = run_workers(model, workers)
+    print(
+        f"Serving on {server['host']}:{server['port']} with {workers} workers, "
+        f"{threads_per_worker(workers)} threads each"
+    )
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+
+
+if __name__ == "__main__":
+    main()
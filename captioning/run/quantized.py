@@ -0,0 +1,64 @@
+"""Compares the quantized first stage against the fp32 one.
+
+Run with `python -m captioning.run.quantized -q static` on a CPU-only box.
+"""
+import torch
+import torch.nn.functional as F
+from tqdm.auto import tqdm
+
+from .. import config
+from ..config import (
+    coco_captions_val,
+    first_stage_dataset,
+    last_checkpoint_path,
+    parse_args,
+)
+from ..model import FeatureExtractor, TermDecoder
+from ..quantization import calibration_images, quantize_dynamic, quantize_extractor
+from ..train.first_stage import evaluate
+
+
+def compare_decoders(mapping):
+    dec = TermDecoder(len(mapping), 2048, 2048)
+    dec.load_state_dict(torch.load(last_checkpoint_path(), map_location="cpu"))
+    dec.eval()
+
+    fp32_score = evaluate(dec, mapping)
+    int8_score = evaluate(quantize_dynamic(dec), mapping)
+
+    for name, value in fp32_score._asdict().items():
+        int8_value = getattr(int8_score, name)
+        print(
+            f"{name}: fp32 {value:.4f}, int8 {int8_value:.4f}, "
+            f"diff {int8_value - value:+.4f}"
+        )
+
+
+def compare_extractors(n=100):
+    dataset, _ = coco_captions_val()
+    extractor = FeatureExtractor().eval()
+    q_extractor = quantize_extractor(calibration_images(dataset))
+
+    similarity = 0
+    with torch.no_grad():
+        for img in tqdm(
+            # Skip the images used for calibration
+            calibration_images(dataset, n, start=32),
+            total=n,
+            desc="Comparing features",
+        ):
+            similarity += F.cosine_similarity(extractor(img), q_extractor(img)).item()
+
+    print(f"Mean cosine similarity of fp32 and int8 features: {similarity / n:.4f}")
+
+
+def main():
+    mapping = first_stage_dataset().get_term_mapping
+    compare_decoders(mapping)
+    if config.quantize == "static":
+        compare_extractors()
+
+
+if __name__ == "__main__":
+    parse_args()
+    main()
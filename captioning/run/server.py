@@ -0,0 +1,219 @@
+"""Local HTTP captioning service with dynamic micro-batching.
+
+Start with `python -m captioning.run.server`, settings are in `config.server`.
+
+    curl --data-binary @img.jpg "localhost:8080/caption?style=none&style=<shake_orig>"
+    curl --data-binary @img.jpg "localhost:8080/stream?style=<shake_orig>"
+    curl localhost:8080/stats
+"""
+import asyncio
+import io
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from statistics import quantiles
+
+import torch
+from aiohttp import web
+from PIL import Image
+
+from ..cache import LRUCache, content_key, nbytes
+from .. import config
+from ..config import autocast, parse_args, server
+from ..model import SemStyle
+from ..profiling import profile
+from .__main__ import STYLES, get_mappings, get_models
+
+
+def decode_image(data):
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    return config.image_transform(img).to(config.device).unsqueeze(0)
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches of at most `max_batch_size`,
+    waiting at most `max_wait` seconds for a batch to fill up. Batches run one at a
+    time in a worker thread, leaving the event loop free to accept requests."""
+
+    def __init__(self, model, max_batch_size=8, max_wait=0.01, history=1000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.latencies = deque(maxlen=history)
+        self.batch_sizes = deque(maxlen=history)
+        self.profiler = None  # started in the worker thread, see infer
+
+    async def submit(self, img, styles, key=None):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((img, styles, key, future, time.perf_counter()))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                results = await loop.run_in_executor(self.executor, self.infer, batch)
+            except Exception as e:  # handed over to the waiting requests
+                for *_, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batch_sizes.append(len(batch))
+            for (*_, future, start), result in zip(batch, results):
+                self.latencies.append(time.perf_counter() - start)
+                if not future.done():  # the client might have gone away
+                    future.set_result(result)
+
+    def infer(self, batch):
+        if self.profiler is None:
+            self.profiler = profile(f"server_{os.getpid()}")  # one per prefork worker
+            self.profiler.start()
+
+        imgs, styles, keys, *_ = zip(*batch)
+        with torch.no_grad(), autocast():
+            results = self.model.forward_batch(list(imgs), list(styles), list(keys))
+        self.profiler.step()
+        return results
+
+    def stats(self):
+        stats = {
+            "queue_depth": self.queue.qsize(),
+            "requests": len(self.latencies),
+            "mean_batch_size": (
+                sum(self.batch_sizes) / len(self.batch_sizes) if self.batch_sizes else 0
+            ),
+        }
+        if len(self.latencies) > 1:
+            percentiles = quantiles(self.latencies, n=100)
+            for p in (50, 90, 99):
+                stats[f"latency_p{p}"] = percentiles[p - 1]
+        return stats
+
+
+async def caption(request):
+    styles = request.query.getall("style", ["none"])
+    if any(style not in STYLES for style in styles):
+        raise web.HTTPBadRequest(text=f"Styles should be some of {list(STYLES)}")
+
+    data = await request.read()
+    loop = asyncio.get_running_loop()
+    try:
+        img = await loop.run_in_executor(None, decode_image, data)
+    except OSError:
+        raise web.HTTPBadRequest(text="Could not decode the image")
+
+    batcher = request.app["batcher"]
+    terms, captions = await batcher.submit(
+        img, [STYLES[style] for style in styles], content_key(data)
+    )
+    return web.json_response(
+        {
+            "terms": terms,
+            "captions": [
+                {"style": style, "caption": " ".join(cap[1:-1]), "confidence": conf}
+                for style, (cap, conf) in zip(styles, captions)
+            ],
+        }
+    )
+
+
+async def stream(request):
+    """Streams the caption as newline delimited JSON, one word per line. Not
+    batched, the decoding stops when the client disconnects."""
+    style = request.query.get("style", "none")
+    if style not in STYLES:
+        raise web.HTTPBadRequest(text=f"Style should be one of {list(STYLES)}")
+
+    data = await request.read()
+    loop = asyncio.get_running_loop()
+    try:
+        img = await loop.run_in_executor(None, decode_image, data)
+    except OSError:
+        raise web.HTTPBadRequest(text="Could not decode the image")
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    model = request.app["batcher"].model
+    words = model.astream(img, STYLES[style], content_key(data), context=autocast)
+    try:
+        async for word, confidence in words:
+            line = json.dumps({"word": word, "confidence": confidence}) + "\n"
+            await response.write(line.encode())
+    finally:
+        await words.aclose()  # stop decoding right away if the client went away
+
+    await response.write_eof()
+    return response
+
+
+async def stats(request):
+    model = request.app["batcher"].model
+    stats = request.app["batcher"].stats()
+    for name, cache in (
+        ("image_cache", model.img_to_term.cache),
+        ("caption_cache", model.caption_cache),
+    ):
+        if cache is not None:
+            stats[name] = cache.stats()
+    return web.json_response(stats)
+
+
+async def start_batcher(app):
+    app["batcher_task"] = asyncio.get_running_loop().create_task(app["batcher"].run())
+
+
+async def stop_batcher(app):
+    app["batcher_task"].cancel()
+    app["batcher"].executor.shutdown()
+
+
+def make_app(model):
+    app = web.Application(client_max_size=server["max_image_bytes"])
+    app["batcher"] = MicroBatcher(
+        model, max_batch_size=server["max_batch_size"], max_wait=server["max_wait"]
+    )
+    app.on_startup.append(start_batcher)
+    app.on_cleanup.append(stop_batcher)
+    app.add_routes(
+        [
+            web.post("/caption", caption),
+            web.post("/stream", stream),
+            web.get("/stats", stats),
+        ]
+    )
+    return app
+
+
+def load_model():
+    cmap, tmap1, tmap = get_mappings()
+    image_cache = LRUCache(server["image_cache_bytes"], sizeof=nbytes)
+    term_gen, lang_gen = get_models(cmap, tmap1, tmap, cache=image_cache)
+    caption_cache = LRUCache(server["caption_cache_entries"])
+    return SemStyle(term_gen, lang_gen, tmap1, tmap, cmap, caption_cache).eval()
+
+
+def main():
+    web.run_app(make_app(load_model()), host=server["host"], port=server["port"])
+
+
+if __name__ == "__main__":
+    parse_args()
+    main()
@@ -1,5 +1,9 @@
+from ..config import parse_args
+from .evaluator import start_if_requested
 from .first_stage import main as first_stage
 from .second_stage import main as second_stage
 
+parse_args()
+start_if_requested()
 first_stage()
 second_stage()
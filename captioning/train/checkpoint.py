@@ -0,0 +1,161 @@
+"""Resumable training: the full training state is saved in the background, with
+atomic renames, every `config.checkpoint["every_steps"]` steps and after each
+epoch. Restart a run from where it stopped with --resume.
+"""
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+from .. import config
+from ..config import checkpoint, logger
+from .distributed import is_main_process
+
+
+def snapshot(obj):
+    """CPU copy of the tensors in (nested) dicts, lists and tuples, unaffected by
+    the training going on."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {key: snapshot(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value) for value in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+class CheckpointWriter:
+    """Saves in a background thread. Files are written under a temporary name and
+    renamed, so a crash never leaves a partial checkpoint behind."""
+
+    def __init__(self, max_pending=2):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def save(self, obj, path):
+        """Enqueues a snapshot of `obj`. Blocks only if `max_pending` saves are
+        still waiting."""
+        if self.error is not None:
+            raise RuntimeError("A previous checkpoint failed") from self.error
+        self.queue.put((snapshot(obj), path))
+
+    def _run(self):
+        while (item := self.queue.get()) is not None:
+            obj, path = item
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            try:
+                torch.save(obj, tmp_path)
+                os.replace(tmp_path, path)
+            except Exception as e:  # raised in the training thread
+                logger.error(f"Could not save {path}: {e}")
+                self.error = e
+
+    def close(self):
+        """Waits for the pending saves."""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("A checkpoint failed") from self.error
+
+
+class Checkpointer:
+    """Saves and restores the training state of a stage: model, optimizer,
+    scheduler, RNGs and position in the data. Only rank 0 saves.
+
+    Args:
+        name (str): e.g. "first_stage", the state goes to
+            experiment_folder/<name>_state.pth
+    """
+
+    def __init__(self, name, model, optimizer, scheduler=None):
+        self.path = config.experiment_folder / f"{name}_state.pth"
+        self.model = model
+        self.optimizer = optimizer
+        self.scheduler = scheduler
+        self.every = checkpoint["every_steps"]
+        self.writer = CheckpointWriter() if is_main_process() else None
+
+        # Where the training starts from
+        self.epoch, self.step = 0, 0
+        self.state = None
+
+    def resume(self):
+        """Reads the saved state, if any, and returns whether there was one. The
+        training starts from its epoch and step, `restore` loads the rest."""
+        if not self.path.exists():
+            return False
+
+        self.state = torch.load(self.path, map_location="cpu")
+        self.epoch, self.step = self.state["epoch"], self.state["step"]
+        print(f"Resuming from epoch {self.epoch}, step {self.step}")
+        return True
+
+    def restore(self):
+        """Called right before the first step: once the model is on its device, so
+        the optimizer state follows it, and after any other use of the RNGs."""
+        if self.state is None:
+            return
+        state, self.state = self.state, None
+        self.model.load_state_dict(state["model"])
+        self.optimizer.load_state_dict(state["optimizer"])
+        if self.scheduler is not None and state["scheduler"] is not None:
+            self.scheduler.load_state_dict(state["scheduler"])
+        set_rng_state(state["rng"])
+
+    def start_step(self, epoch):
+        return self.step if epoch == self.epoch else 0
+
+    def save(self, epoch, step):
+        """Saves the state after `step` steps of `epoch`."""
+        if self.writer is None:
+            return
+        scheduler = self.scheduler.state_dict() if self.scheduler else None
+        state = {
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": scheduler,
+            "epoch": epoch,
+            "step": step,
+            "rng": get_rng_state(),
+        }
+        self.writer.save(state, self.path)
+
+    def step_done(self, epoch, step):
+        if step % self.every == 0:
+            self.save(epoch, step)
+
+    def epoch_done(self, epoch, weights_path):
+        """Saves the state at the start of the next epoch and the weights alone,
+        for evaluation and inference, to `weights_path`."""
+        if self.writer is None:
+            return
+        self.save(epoch + 1, 0)
+        self.writer.save(self.model.state_dict(), weights_path)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -0,0 +1,160 @@
+"""Data-parallel CPU training: one process per rank, gradients averaged over gloo.
+
+    python -m captioning.train.distributed -n 4 --stage 1
+    python -m captioning.train.distributed --scaling 1 2 4 8  # throughput report
+
+Each rank reads its own shard of the dataset (ResumableSampler) with
+`config.first_stage["batch_size"]` samples per step, so the global batch grows
+with the number of processes. Only rank 0 writes to TensorBoard and saves
+checkpoints. The cores are split evenly between the ranks.
+"""
+import os
+import sys
+from itertools import islice
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch import nn
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+from ..config import distributed, get_parser, parse_args
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+class ResumableSampler(DistributedSampler):
+    """Shuffles with a seed fixed per epoch, over the shard of this rank when
+    running distributed and over the whole dataset otherwise, and can start in the
+    middle of an epoch."""
+
+    def __init__(self, dataset, seed=0):
+        single = {} if dist.is_initialized() else {"num_replicas": 1, "rank": 0}
+        super().__init__(dataset, shuffle=True, **single)
+        self.seed = seed  # DistributedSampler only takes a seed since torch 1.7
+        self.start = 0
+
+    def set_position(self, epoch, start=0):
+        self.set_epoch(epoch)
+        self.start = start
+
+    def indices(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.dataset), generator=generator).tolist()
+        indices += indices[: self.total_size - len(indices)]  # same size shards
+        return indices[self.rank : self.total_size : self.num_replicas]
+
+    def __iter__(self):
+        return islice(self.indices(), self.start, None)
+
+    def __len__(self):
+        return self.num_samples - self.start
+
+
+def wrap_model(model, find_unused_parameters=False):
+    """Synchronizes the gradients of `model` when running distributed. Set
+    `find_unused_parameters` when some parameters may get no gradient in a step."""
+    if not dist.is_initialized():
+        return model
+    return DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+
+
+class LossModule(nn.Module):
+    """Exposes `model.loss` as forward. DistributedDataParallel only syncs
+    gradients of what went through its forward."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, *args):
+        return self.model.loss(*args)
+
+
+def get_launcher_parser():
+    parser = get_parser()
+    parser.add_argument("-n", "--nprocs", type=int, help='distributed["nprocs"]')
+    parser.add_argument("--stage", choices=["1", "2", "both"], default="both")
+    parser.add_argument("--scaling", type=int, nargs="+", metavar="NPROCS")
+    return parser
+
+
+def init_process(rank, world_size):
+    os.environ.setdefault("MASTER_ADDR", distributed["master_addr"])
+    os.environ.setdefault("MASTER_PORT", str(distributed["master_port"]))
+    dist.init_process_group(distributed["backend"], rank=rank, world_size=world_size)
+    torch.set_num_threads(max(1, os.cpu_count() // world_size))
+
+
+def run_training(rank, world_size, argv):
+    args = parse_args(argv, parser=get_launcher_parser())
+    init_process(rank, world_size)
+
+    from . import first_stage, second_stage
+
+    try:
+        if args.stage in ("1", "both"):
+            first_stage.main()
+        if args.stage in ("2", "both"):
+            second_stage.main()
+    finally:
+        dist.destroy_process_group()
+
+
+def run_benchmark(rank, world_size, argv, results):
+    """Times `distributed["scaling_steps"]` training steps, rank 0 puts the
+    throughput in samples/sec into `results`."""
+    args = parse_args(argv, parser=get_launcher_parser())
+    init_process(rank, world_size)
+
+    from . import first_stage, second_stage
+
+    stage = second_stage if args.stage == "2" else first_stage
+    steps = distributed["scaling_steps"]
+    try:
+        # the data and the model are loaded before the timing starts
+        samples, elapsed = stage.benchmark(steps, ready=dist.barrier)
+        elapsed = torch.tensor(elapsed)
+        dist.all_reduce(elapsed, op=dist.ReduceOp.MAX)  # the slowest rank
+        if rank == 0:
+            results.put(samples * world_size / elapsed.item())
+    finally:
+        dist.destroy_process_group()
+
+
+def scaling_report(worker_counts, argv):
+    ctx = mp.get_context("spawn")
+    results = ctx.SimpleQueue()
+    throughput = {}
+    for n in worker_counts:
+        mp.spawn(run_benchmark, args=(n, argv, results), nprocs=n)
+        throughput[n] = results.get()
+
+    base = throughput[worker_counts[0]] / worker_counts[0]
+    print(f"{'procs':>6} {'samples/s':>10} {'speedup':>8} {'efficiency':>11}")
+    for n, samples_per_sec in throughput.items():
+        speedup = samples_per_sec / (base * worker_counts[0])
+        efficiency = samples_per_sec / (base * n)
+        print(f"{n:>6} {samples_per_sec:>10.1f} {speedup:>8.2f} {efficiency:>11.1%}")
+
+
+def main(argv=None):
+    args = parse_args(argv, parser=get_launcher_parser())
+    argv = sys.argv[1:] if argv is None else argv
+
+    if args.scaling:
+        scaling_report(args.scaling, argv)
+    else:
+        from .evaluator import start_if_requested
+
+        start_if_requested()
+        nprocs = args.nprocs or distributed["nprocs"]
+        mp.spawn(run_training, args=(nprocs, argv), nprocs=nprocs)
+
+
+if __name__ == "__main__":
+    main()
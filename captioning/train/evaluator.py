@@ -0,0 +1,187 @@
+"""Scores the checkpoints of an experiment as the training writes them, so the
+training never waits on evaluation.
+
+    python -m captioning.train.evaluator -x 3
+
+First stage checkpoints (model_ep*.pth) get the scores of first_stage.evaluate,
+second stage ones (language_ep*.pth) the validation NLL and perplexity. They go
+to the experiment's TensorBoard run at the step the training reached. Started by
+the training with --background_eval, it exits once the training is over and the
+last checkpoint is scored.
+"""
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import time
+
+import torch
+from torch.utils.tensorboard import SummaryWriter
+
+from .. import config
+from ..config import (
+    evaluator,
+    first_stage,
+    first_stage_dataset,
+    get_parser,
+    logger,
+    parse_args,
+    second_stage,
+    second_stage_dataset,
+    settings_env,
+)
+from ..model import TermDecoder
+
+STAGES = {"model": 1, "language": 2}
+CHECKPOINT_RE = re.compile(r"(model|language)_ep(\d+)\.pth")
+
+
+def pending_checkpoints(folder, done, settle=None):
+    """Checkpoints not in `done`, untouched for `settle` seconds (defaults to
+    `evaluator["settle"]`), oldest first."""
+    settle = evaluator["settle"] if settle is None else settle
+    paths = []
+    for path in folder.iterdir():
+        if CHECKPOINT_RE.fullmatch(path.name) and path.name not in done:
+            if time.time() - path.stat().st_mtime >= settle:
+                paths.append(path)
+    return sorted(paths, key=lambda p: p.stat().st_mtime)
+
+
+class CheckpointScorer:
+    """Loads the vocabulary or the datasets of a stage the first time one of its
+    checkpoints is scored."""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self._first_stage_vocab = None
+        self.second_stage_dataset = None
+
+    def __call__(self, path):
+        stage, epoch = CHECKPOINT_RE.fullmatch(path.name).groups()
+        state_dict = torch.load(path, map_location="cpu")
+        if STAGES[stage] == 1:
+            scores, step = self.score_first_stage(state_dict, int(epoch))
+        else:
+            scores, step = self.score_second_stage(state_dict, int(epoch))
+
+        for name, value in scores.items():
+            self.writer.add_scalar(f"Score: {name}", value, step)
+        self.writer.flush()
+        return scores, step
+
+    def first_stage_vocab(self):
+        """The term mapping and the training set size, saved by the training.
+        Experiments older than that need the dataset."""
+        from .first_stage import load_vocab
+
+        if self._first_stage_vocab is None:
+            self._first_stage_vocab = load_vocab(config.experiment_folder)
+        if self._first_stage_vocab is None:
+            dataset = first_stage_dataset()
+            dataset.close()  # only the mapping is needed
+            self._first_stage_vocab = dataset.get_term_mapping, len(dataset)
+        return self._first_stage_vocab
+
+    def score_first_stage(self, state_dict, epoch):
+        from .first_stage import evaluate
+
+        mapping, samples = self.first_stage_vocab()
+        model = TermDecoder(len(mapping), 2048, 2048)
+        model.load_state_dict(state_dict)
+        # Same step as the training used, model_ep001 is saved after one epoch
+        step = epoch * samples // first_stage["batch_size"]
+        return evaluate(model, mapping)._asdict(), step
+
+    def score_second_stage(self, state_dict, epoch):
+        from .second_stage import evaluate, get_model
+
+        if self.second_stage_dataset is None:
+            self.second_stage_dataset = second_stage_dataset()
+        dataset = self.second_stage_dataset
+
+        model = get_model(dataset)
+        model.load_state_dict(state_dict)
+        # language_ep000 is saved after one epoch
+        step = (epoch + 1) * math.ceil(len(dataset) / second_stage["batch_size"])
+        scores = evaluate(model, dataset.get_cap_mapping, dataset.get_term_mapping)
+        return scores, step
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def watch(until_pid=None, poll=None):
+    """Scores new checkpoints until `until_pid` exits, or forever, looking for
+    them every `poll` seconds (defaults to `evaluator["poll"]`)."""
+    poll = evaluator["poll"] if poll is None else poll
+    folder = config.experiment_folder
+    done_path = folder / "evaluated.json"
+    scores_path = folder / "scores.jsonl"  # read by train.sweep
+    done = set(json.loads(done_path.read_text())) if done_path.exists() else set()
+    failed = {}  # name: mtime, only retried once the checkpoint changes
+
+    torch.set_num_threads(evaluator["threads"])
+    writer = SummaryWriter(folder)
+    score = CheckpointScorer(writer)
+
+    try:
+        while True:
+            training_over = until_pid is not None and not process_alive(until_pid)
+            # Once the training is over, every checkpoint is complete
+            settle = 0 if training_over else evaluator["settle"]
+            for path in pending_checkpoints(folder, done, settle):
+                mtime = path.stat().st_mtime
+                if failed.get(path.name) == mtime:
+                    continue
+                try:
+                    scores, step = score(path)
+                except (RuntimeError, EOFError) as e:  # e.g. a shape mismatch
+                    logger.warning(f"Could not score {path.name}: {e}")
+                    failed[path.name] = mtime
+                    continue
+                print(f"{path.name}: {scores}")
+                with open(scores_path, "a") as f:
+                    record = {"checkpoint": path.name, "step": step, **scores}
+                    f.write(json.dumps(record) + "\n")
+                done.add(path.name)
+                done_path.write_text(json.dumps(sorted(done)))
+
+            if training_over:
+                return
+            time.sleep(poll)
+    finally:
+        writer.close()
+
+
+def start():
+    """Starts the evaluator in the background, for the calling process and with
+    its settings (passed through the environment)."""
+    env = dict(os.environ, **settings_env())
+    return subprocess.Popen(
+        [sys.executable, "-m", __name__, "--until_pid", str(os.getpid())], env=env
+    )
+
+
+def start_if_requested():
+    """Called by the training entry points, see --background_eval."""
+    if config.background_eval:
+        return start()
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("--until_pid", type=int)
+    args = parse_args(parser=parser)
+    watch(args.until_pid)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,34 @@
+import json
+import math
+import time
 from contextlib import closing
-from itertools import islice
+from multiprocessing import Pool
 from statistics import fmean
 
 import torch
 from nltk.translate.bleu_score import sentence_bleu
 from recordclass import recordclass
 from torch import nn
+from torch.autograd.profiler import record_function
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm.auto import tqdm, trange
 
+from .. import config
 from ..config import (
+    autocast,
     coco_val_conf,
-    device,
-    experiment_folder,
     first_stage,
-    first_stage_dataset
+    first_stage_dataset,
+    parse_args,
 )
 from ..dataset import ValidationDataset
 from ..model import TermDecoder
-from ..utils import get_yn_response
+from ..profiling import profile
+from ..utils import WordIdxMap, count_parameters
+from .checkpoint import Checkpointer
+from .distributed import ResumableSampler, is_main_process, wrap_model
+from .instrument import StepTimer, trace_path
 from .misc import extract_caption_len
 
 
@@ -32,84 +41,160 @@ def to_batch_format(sample):
     return feats, caption, caption_len
 
 
-def train(dataset, mapping, model, writer, criterion, optimizer):
-
+def train(
+    dataset,
+    mapping,
+    model,
+    writer,
+    criterion,
+    optimizer,
+    max_steps=None,
+    checkpointer=None,
+):
+    """Yields the model after each epoch.
+
+    Args:
+        writer (SummaryWriter): None in the distributed ranks other than 0.
+        max_steps (int, optional): Cut the epochs short, for benchmarking.
+        checkpointer (Checkpointer, optional): Saves the training state every few
+            steps, and gives the epoch and step to start from when resuming.
+    """
+    device = config.device
+
+    batch_size = first_stage["batch_size"]
+    sampler = ResumableSampler(dataset)
     dataloader = DataLoader(
-        dataset, batch_size=first_stage["batch_size"], num_workers=4, shuffle=True
+        dataset,
+        batch_size=batch_size,
+        num_workers=first_stage["num_workers"],
+        sampler=sampler,
     )
+    steps_per_epoch = math.ceil(sampler.num_samples / batch_size)
     sample_feats, sample_caption, sample_caption_len = to_batch_format(dataset[0])
 
     model = model.train().to("cpu")
-    writer.add_graph(
-        model, input_to_model=(sample_feats, sample_caption, sample_caption_len)
-    )
+    if writer is not None:
+        writer.add_graph(
+            model, input_to_model=(sample_feats, sample_caption, sample_caption_len)
+        )
     model = model.to(device)
-
-    for epoch in trange(first_stage["epochs"], desc="Epochs"):
-        running_loss = 0
-        model = model.train()
-
-        for i, data in enumerate(tqdm(dataloader, desc="Batches")):
-            features, captions = data
-
-            captions, caption_lens = extract_caption_len(captions)
-
-            caption_lens += 1  # We add the <start> token
-
-            captions = captions.to(device)
-            features = features.to(device)
-            caption_lens = caption_lens.to(device)
-
-            optimizer.zero_grad()
-
-            targets = captions.detach().clone()[:, 1:]
-            outputs, hidden = model(
-                features, captions[:, :-1].detach().clone(), caption_lens
+    ddp_model = wrap_model(model)
+    timer = StepTimer(writer, trace_path("first_stage"), device)
+
+    start_epoch = 0
+    if checkpointer is not None:
+        start_epoch = checkpointer.epoch
+        checkpointer.restore()
+
+    prof = profile("first_stage")
+    prof.start()
+    try:
+        for epoch in trange(start_epoch, first_stage["epochs"], desc="Epochs"):
+            running_loss = 0
+            model = model.train()
+            start = checkpointer.start_step(epoch) if checkpointer is not None else 0
+            sampler.set_position(epoch, start * batch_size)
+
+            batches = tqdm(
+                timer.iterate(dataloader),
+                total=steps_per_epoch,
+                initial=start,
+                desc="Batches",
             )
-            loss = criterion(outputs.permute(0, 2, 1), targets)
-            loss.backward()
-            optimizer.step()
-
-            running_loss += loss.item()
-
-            if i % 50 == 49:
-                step_number = epoch * len(dataloader) + i
-                writer.add_scalar("Training loss", running_loss / 50, step_number)
-
-                running_loss = 0
-
-                model.eval()
-                words, confidence = model.forward_eval(sample_feats.to(device), mapping)
-
-                tmp = sample_caption.reshape((-1)).tolist()
-                writer.add_text("Target", f"{list(mapping.decode(tmp))}", step_number)
-                writer.add_text("Predictions", f"{words}", step_number)
-                writer.add_scalar(
-                    "Mean confidence", sum(confidence) / len(confidence), step_number
-                )
-
-                model.train()
-
-        # after each epoch
-        yield model
+            for i, data in enumerate(batches, start):
+                if i == max_steps:
+                    break
+                features, captions = data
+
+                captions, caption_lens = extract_caption_len(captions)
+
+                caption_lens += 1  # We add the <start> token
+                tokens = int(caption_lens.sum())
+
+                with timer.phase("h2d"):
+                    captions = captions.to(device)
+                    features = features.to(device)
+                    caption_lens = caption_lens.to(device)
+
+                with timer.phase("optimizer"):
+                    optimizer.zero_grad()
+
+                targets = captions.detach().clone()[:, 1:]
+                with timer.phase("forward"):
+                    with autocast():
+                        outputs, hidden = ddp_model(
+                            features, captions[:, :-1].detach().clone(), caption_lens
+                        )
+                    with record_function("loss"):
+                        loss = criterion(outputs.permute(0, 2, 1), targets)
+                with timer.phase("backward"):
+                    loss.backward()
+                with timer.phase("optimizer"):
+                    optimizer.step()
+
+                loss_value = loss.item()
+                running_loss += loss_value
+                step_number = epoch * steps_per_epoch + i
+                timer.step(step_number, len(features), tokens, loss=loss_value)
+                prof.step()
+                with timer.paused():
+                    if checkpointer is not None:
+                        checkpointer.step_done(epoch, i + 1)
+
+                    if writer is not None and i % 50 == 49:
+                        writer.add_scalar(
+                            "Training loss", running_loss / 50, step_number
+                        )
+
+                        running_loss = 0
+
+                        model.eval()
+                        with torch.no_grad(), autocast():
+                            words, confidence = model.forward_eval(
+                                sample_feats.to(device), mapping
+                            )
+
+                        tmp = sample_caption.reshape((-1)).tolist()
+                        writer.add_text(
+                            "Target", f"{list(mapping.decode(tmp))}", step_number
+                        )
+                        writer.add_text("Predictions", f"{words}", step_number)
+                        writer.add_scalar(
+                            "Mean confidence",
+                            sum(confidence) / len(confidence),
+                            step_number,
+                        )
+
+                        model.train()
+
+            # after each epoch
+            yield model
+    finally:
+        prof.stop()
+        timer.close()
 
 
 def precision(target, prediction):
     """Precision = TP/(TP + FP)"""
-    if len(prediction) == 0:
-        return 0
-    tp = sum(1 for p in prediction if p in target)
-    return tp / len(prediction)
+    return precision_recall(target, prediction)[0]
 
 
 def recall(target, prediction):
     """Recall = TP/(TP + FN)"""
-    if len(target) == 0:
-        return 0
-    tp = sum(1 for p in prediction if p in target)
-    return tp / len(target)
+    return precision_recall(target, prediction)[1]
+
+
+def precision_recall(target, prediction):
+    target_set = set(target)
+    tp = sum(1 for p in prediction if p in target_set)
+    return (
+        tp / len(prediction) if prediction else 0,
+        tp / len(target) if target else 0,
+    )
 
 
+VOCAB_FILE = "first_stage_vocab.json"  # read by train.evaluator
+
 Score = recordclass(
     "Score",
     ["bleu", "avg_precision", "max_precision", "avg_recall", "max_recall"],
@@ -117,83 +202,169 @@ Score = recordclass(
 )
 
 
-def evaluate(model, mapping):
-
-    if not hasattr(evaluate, "dataset"):
-        evaluate.dataset = ValidationDataset(
-            coco_val_conf["features"], coco_val_conf["final"],
-        )
-    else:
-        evaluate.dataset.open_feats()
-
-    model.eval()
-    model.to(device)
-
-    score = Score()
-
-    eval_size = 1000
-
-    for feats, targets in tqdm(
-        islice(evaluate.dataset, eval_size), total=eval_size, desc="Evaluating"
-    ):
-        feats = torch.Tensor(feats).unsqueeze(0)
-        prediction, confidence = model.forward_eval(feats.to(device), mapping)
-        prediction = prediction[1:-1]  # strip <start> and <end>
-
-        score.bleu += sentence_bleu(targets, prediction, (1,)) / eval_size
-
-        p = list(precision(t, prediction) for t in targets)
-        r = list(recall(t, prediction) for t in targets)
-
-        score.avg_precision += fmean(p) / eval_size
-        score.max_precision += max(p) / eval_size
-        score.avg_recall += fmean(r) / eval_size
-        score.max_recall += max(r) / eval_size
-
-    evaluate.dataset.close()
-    return score
+def sample_score(sample):
+    """The Score fields of one prediction against its targets, run in the pool."""
+    targets, prediction = sample
+    p, r = zip(*(precision_recall(t, prediction) for t in targets))
+    bleu = sentence_bleu(targets, prediction, (1,))
+    return bleu, fmean(p), max(p), fmean(r), max(r)
+
+
+class Evaluator:
+    """Scores term decoders on the validation set. The features are read once and
+    kept in memory, the terms are decoded in batches and BLEU, precision and
+    recall are computed by a pool of processes."""
+
+    def __init__(self, batch_size=256, processes=None):
+        dataset = ValidationDataset(coco_val_conf["features"], coco_val_conf["final"])
+        with closing(dataset):
+            self.features = torch.from_numpy(dataset.features[...])
+            self.targets = [dataset.feat_targets[i] for i in dataset.feat_ids[...]]
+        self.batch_size = batch_size
+        self.processes = processes
+
+    def __len__(self):
+        return len(self.targets)
+
+    def decode(self, model, mapping, n):
+        device = config.device
+        model.eval()
+        model.to(device)
+
+        predictions = []
+        for start in trange(0, n, self.batch_size, desc="Evaluating"):
+            feats = self.features[start : min(start + self.batch_size, n)]
+            with torch.no_grad(), autocast():
+                decoded = model.forward_eval_batch(feats.to(device), mapping)
+            # strip <start> and <end>
+            predictions.extend(terms[1:-1] for terms, _ in decoded)
+        return predictions
+
+    def __call__(self, model, mapping, n=None):
+        """Mean Score over the first `n` images, all of them if `n` is None. An
+        empty Score if there are none."""
+        n = len(self) if n is None else min(n, len(self))
+        if n == 0:
+            return Score()
+        predictions = self.decode(model, mapping, n)
+        targets = self.targets[:n]
+
+        with Pool(self.processes) as pool:
+            scores = pool.map(sample_score, zip(targets, predictions), chunksize=64)
+        return Score(*map(fmean, zip(*scores)))
+
+
+def save_vocab(folder, mapping, samples):
+    """Saves the term vocabulary and the dataset size next to the checkpoints, so
+    that they can be scored without loading the dataset."""
+    vocab = {"idx2word": mapping.idx2word, "counts": mapping.counts}
+    (folder / VOCAB_FILE).write_text(json.dumps({**vocab, "samples": samples}))
+
+
+def load_vocab(folder):
+    """The term mapping and dataset size saved by `save_vocab`, None if there are
+    none."""
+    path = folder / VOCAB_FILE
+    if not path.exists():
+        return None
+    vocab = json.loads(path.read_text())
+    samples = vocab.pop("samples")
+    return WordIdxMap.from_idx2word(**vocab), samples
+
+
+def evaluate(model, mapping, n=None):
+    """Score of the model on `n` validation images, defaults to
+    `first_stage["eval_size"]`, all of them if that's None too."""
+    n = first_stage["eval_size"] if n is None else n
+    if not hasattr(evaluate, "evaluator"):
+        evaluate.evaluator = Evaluator(first_stage["eval_batch_size"])
+    return evaluate.evaluator(model, mapping, n)
 
 
 def main():
+    experiment_folder = config.experiment_folder
+    main_process = is_main_process()
+
     dataset = first_stage_dataset()
 
     mapping = dataset.get_term_mapping
 
-    writer = SummaryWriter(experiment_folder)
+    writer = SummaryWriter(experiment_folder) if main_process else None
+    if main_process:
+        save_vocab(experiment_folder, mapping, len(dataset))
 
     vocab_size = len(mapping)
     # TODO: config
     model = TermDecoder(vocab_size, 2048, 2048)
-
-    print(f"SCORE: {evaluate(model, mapping)}")
+    print(f"Vocabulary size: {vocab_size}, parameters: {count_parameters(model)}")
 
     criterion = nn.NLLLoss()  # TODO try nn.MSELoss()
     optimizer = torch.optim.Adam(model.parameters(), lr=first_stage["learning_rate"])
+    checkpointer = Checkpointer("first_stage", model, optimizer)
+    resumed = config.resume and checkpointer.resume()
+
+    evaluate_inline = main_process and not config.background_eval
+    if evaluate_inline and not resumed:
+        print(f"SCORE: {evaluate(model, mapping)}")
 
     with closing(dataset):
         try:
             for epoch, trained_model in enumerate(
-                train(dataset, mapping, model, writer, criterion, optimizer)
+                train(
+                    dataset,
+                    mapping,
+                    model,
+                    writer,
+                    criterion,
+                    optimizer,
+                    checkpointer=checkpointer,
+                ),
+                checkpointer.epoch,
             ):
-                torch.save(
-                    trained_model.state_dict(),
-                    experiment_folder / f"model_ep{(epoch + 1):03d}.pth",
+                checkpointer.epoch_done(
+                    epoch, experiment_folder / f"model_ep{(epoch + 1):03d}.pth"
                 )
+                if not evaluate_inline:
+                    continue
                 score = evaluate(trained_model, mapping)
                 step = (epoch + 1) * len(dataset) // first_stage["batch_size"]
 
                 for name, value in score._asdict().items():
                     writer.add_scalar(f"Score: {name}", value, step)
 
-        except:  # noqa
-            if get_yn_response("Remove experiment folder? [y/N]"):
-                import shutil
+        finally:
+            # Waits for the pending saves, --resume continues from the last one
+            checkpointer.close()
+
+    if writer is not None:
+        writer.close()
 
-                shutil.rmtree(experiment_folder, ignore_errors=True)
-            raise
 
-    writer.close()
+def benchmark(steps, ready=None):
+    """Runs `steps` training steps. Returns the number of samples processed and
+    the seconds they took, the loading of the data and the model excluded.
+
+    Args:
+        ready (callable, optional): Called once everything is loaded, right
+            before the timing starts, e.g. a barrier between distributed ranks.
+    """
+    dataset = first_stage_dataset()  # cached, left open for the next call
+    mapping = dataset.get_term_mapping
+    model = TermDecoder(len(mapping), 2048, 2048)
+    optimizer = torch.optim.Adam(model.parameters(), lr=first_stage["learning_rate"])
+    if ready is not None:
+        ready()
+
+    start = time.perf_counter()
+    next(train(dataset, mapping, model, None, nn.NLLLoss(), optimizer, steps))
+    return steps * first_stage["batch_size"], time.perf_counter() - start
 
 
 if __name__ == "__main__":
+    from .evaluator import start_if_requested
+
+    parse_args()
+    if first_stage["threads"]:
+        torch.set_num_threads(first_stage["threads"])
+    start_if_requested()
     main()
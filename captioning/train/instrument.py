@@ -0,0 +1,151 @@
+"""Per-step timing of the training loops, to tell data stalls from compute.
+
+Every step is split into data wait, host to device copy, forward, backward and
+optimizer phases. Averages over `log_every` steps go to TensorBoard, along with
+samples/sec, tokens/sec and the number of batches the DataLoader workers have
+ready. With --trace every step is also appended to a JSONL file. The work between
+steps, such as checkpoints and logging, is left out of the wall time.
+"""
+import json
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import torch
+from torch.autograd.profiler import record_function
+
+from .. import config
+from .distributed import is_main_process
+
+PHASES = ("data", "h2d", "forward", "backward", "optimizer")
+
+
+def queue_depth(iterator):
+    """Batches prefetched by the DataLoader workers and waiting to be consumed,
+    None for single process loading or where the queue size is unavailable."""
+    try:
+        return iterator._data_queue.qsize()
+    except (AttributeError, NotImplementedError):
+        return None
+
+
+def trace_path(name):
+    """Where the trace of a training loop goes, None if tracing is off."""
+    if config.trace and is_main_process():
+        return config.experiment_folder / f"trace_{name}.jsonl"
+    return None
+
+
+class StepTimer:
+    """
+    Args:
+        writer (SummaryWriter, optional): Receives the averages.
+        trace_path (Path, optional): JSONL file getting a line per step.
+        device (torch.device, optional): CUDA work is synchronized before each
+            measurement, the timings would be meaningless otherwise.
+        log_every (int, optional): Defaults to 50, like the loss.
+    """
+
+    def __init__(self, writer=None, trace_path=None, device=None, log_every=50):
+        self.writer = writer
+        self.trace = open(trace_path, "a") if trace_path else None
+        self.sync = device is not None and torch.device(device).type == "cuda"
+        self.log_every = log_every
+
+        self.current = defaultdict(float)
+        self.window = defaultdict(float)
+        self.window_steps = 0
+        self.last_step_end = None
+        self.iterator = None
+
+    def _now(self):
+        if self.sync:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        start = self._now()
+        try:
+            with record_function(name):  # labels the phase in --profile traces
+                yield
+        finally:
+            self.current[name] += self._now() - start
+
+    @contextmanager
+    def paused(self):
+        """Leaves the time spent inside out of the next step's wall time, for the
+        work between steps such as checkpoints or sample predictions."""
+        start = self._now()
+        try:
+            yield
+        finally:
+            self.last_step_end += self._now() - start
+
+    def iterate(self, dataloader):
+        """Yields the batches of `dataloader`, timing the wait for each one."""
+        self.iterator = iter(dataloader)
+        self.last_step_end = self._now()
+        while True:
+            with self.phase("data"):
+                batch = next(self.iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def step(self, step, samples, tokens, **extra):
+        """Closes the measurements of a step.
+
+        Args:
+            step (int): The global step, used as the TensorBoard x axis.
+            samples (int): The batch size.
+            tokens (int): Words in the batch, without padding.
+            extra: Added to the trace, e.g. the loss.
+        """
+        end = self._now()
+        record = {
+            "step": step,
+            "time": time.time(),
+            "wall": end - self.last_step_end,
+            **{name: self.current[name] for name in PHASES},
+            "samples": samples,
+            "tokens": tokens,
+            "queue_depth": queue_depth(self.iterator),
+            **extra,
+        }
+        self.current.clear()
+
+        if self.trace is not None:
+            self.trace.write(json.dumps(record) + "\n")
+
+        for name in ("wall", "samples", "tokens", *PHASES):
+            self.window[name] += record[name]
+        if record["queue_depth"] is not None:
+            self.window["queue_depth"] += record["queue_depth"]
+        self.window_steps += 1
+
+        if self.window_steps == self.log_every:
+            self.flush(step)
+        self.last_step_end = self._now()  # the trace and TensorBoard writes excluded
+
+    def flush(self, step):
+        if self.writer is not None and self.window_steps:
+            n, wall = self.window_steps, self.window["wall"]
+            for name in PHASES:
+                ms = self.window[name] / n * 1e3
+                self.writer.add_scalar(f"Time/{name} ms", ms, step)
+            self.writer.add_scalar(
+                "Throughput/samples per sec", self.window["samples"] / wall, step
+            )
+            self.writer.add_scalar(
+                "Throughput/tokens per sec", self.window["tokens"] / wall, step
+            )
+            self.writer.add_scalar(
+                "DataLoader/queue depth", self.window["queue_depth"] / n, step
+            )
+        self.window.clear()
+        self.window_steps = 0
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.close()
@@ -1,79 +1,250 @@
 # %%
+import math
+import time
+
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from .. import config
 from ..config import (
-    device,
-    experiment_folder,
+    autocast,
+    coco_val_conf,
+    parse_args,
     second_stage,
     second_stage_dataset,
 )
+from ..dataset import LanguageValidationDataset
 from ..model import LanguageGenerator, SentenceDecoderWithAttention, TermEncoder
-from .misc import extract_caption_len
+from ..profiling import NoProfiler, profile
+from ..utils import count_parameters
+from .checkpoint import Checkpointer
+from .distributed import LossModule, ResumableSampler, is_main_process, wrap_model
+from .instrument import StepTimer, trace_path
+from .misc import extract_caption_len, filter_short
 
 # In case of "RuntimeError: received 0 items of ancdata"
 # https://github.com/pytorch/pytorch/issues/973
 # torch.multiprocessing.set_sharing_strategy("file_system")
 
 
-def train(model, dataset, mapping, criterion, optimizer, writer, epoch):
-
+def train(
+    model,
+    loss_module,
+    dataset,
+    mapping,
+    criterion,
+    optimizer,
+    writer,
+    epoch,
+    max_steps=None,
+    checkpointer=None,
+):
+    """One epoch.
+
+    Args:
+        loss_module: `model` wrapped by `wrap_loss`.
+        writer (SummaryWriter): None in the distributed ranks other than 0.
+        max_steps (int, optional): Cut the epoch short, for benchmarking.
+        checkpointer (Checkpointer, optional): Saves the training state every few
+            steps, and gives the step to start from when resuming.
+    """
+    device = config.device
+
+    batch_size = second_stage["batch_size"]
+    start = checkpointer.start_step(epoch) if checkpointer is not None else 0
+    sampler = ResumableSampler(dataset)
+    sampler.set_position(epoch, start * batch_size)
     dataloader = DataLoader(
-        dataset, batch_size=second_stage["batch_size"], num_workers=4, shuffle=True
+        dataset,
+        batch_size=batch_size,
+        num_workers=second_stage["num_workers"],
+        sampler=sampler,
     )
+    steps_per_epoch = math.ceil(sampler.num_samples / batch_size)
 
     model = model.train().to(device)
+    timer = StepTimer(writer, trace_path("second_stage"), device)
+    if checkpointer is not None:
+        checkpointer.restore()
+
+    first_epoch = checkpointer.epoch if checkpointer is not None else 0
+    prof = profile("second_stage") if epoch == first_epoch else NoProfiler()
+    prof.start()
     running_loss = 0
-    for i, data in enumerate(tqdm(dataloader, desc="Batches")):
+    batches = tqdm(
+        timer.iterate(dataloader), total=steps_per_epoch, initial=start, desc="Batches"
+    )
+    for i, data in enumerate(batches, start):
+        if i == max_steps:
+            break
 
         caps, terms = data
-        caps, terms = torch.stack(caps).to(device), torch.stack(terms).to(device)
+        with timer.phase("h2d"):
+            caps, terms = torch.stack(caps).to(device), torch.stack(terms).to(device)
         caps, clens = extract_caption_len(caps.T)
         terms, tlens = extract_caption_len(terms.T)
 
         targets = caps.detach().clone()[:, 1:]
 
-        optimizer.zero_grad()
+        with timer.phase("optimizer"):
+            optimizer.zero_grad()
+
+        with timer.phase("forward"), autocast():
+            # the loss itself is computed on fp32 log-probs
+            loss, hidden, attn = loss_module(
+                terms, tlens, caps[:, :-1], clens + 1, targets, criterion  # <start>
+            )
+        with timer.phase("backward"):
+            loss.backward()
+        with timer.phase("optimizer"):
+            optimizer.step()
+
+        loss_value = loss.item()
+        running_loss += loss_value
+        step_number = epoch * steps_per_epoch + i
+        timer.step(step_number, len(caps), int(clens.sum()), loss=loss_value)
+        prof.step()
+        with timer.paused():
+            if checkpointer is not None:
+                checkpointer.step_done(epoch, i + 1)
+
+            if writer is not None and i % 50 == 49:
+                writer.add_scalar("Training loss", running_loss / 50, step_number)
+                running_loss = 0
+
+    prof.stop()
+    timer.close()
+    return model
 
-        out, hidden, attn = model(terms, tlens, caps[:, :-1], clens + 1)  # add <start>
-        loss = criterion(out.permute(0, 2, 1), targets)
-        loss.backward()
-        optimizer.step()
 
-        running_loss += loss.item()
+def evaluate(model, cmapping, tmapping):
+    """Mean negative log-likelihood per word of the validation captions given
+    their terms, and the perplexity."""
+    device = config.device
 
-        if i % 50 == 49:
-            step_number = epoch * len(dataloader) + i
-            writer.add_scalar("Training loss", running_loss / 50, step_number)
-            running_loss = 0
+    if not hasattr(evaluate, "dataset"):
+        evaluate.dataset = LanguageValidationDataset(
+            coco_val_conf["final"], cmapping, tmapping, filter_fn=filter_short
+        )
+    dataloader = DataLoader(
+        evaluate.dataset, batch_size=second_stage["eval_batch_size"]
+    )
 
-    return model
+    model = model.eval().to(device)
+    criterion = nn.NLLLoss(ignore_index=0)
+    total_nll, total_words = 0, 0
+    for caps, terms in tqdm(dataloader, desc="Evaluating"):
+        caps, terms = torch.stack(caps).to(device), torch.stack(terms).to(device)
+        caps, clens = extract_caption_len(caps.T)
+        terms, tlens = extract_caption_len(terms.T)
+        targets = caps[:, 1:]
+
+        with torch.no_grad(), autocast():
+            loss, _, _ = model.loss(
+                terms, tlens, caps[:, :-1], clens + 1, targets, criterion
+            )
+        words = int((targets != 0).sum())  # the loss is a mean over the words
+        total_nll += loss.item() * words
+        total_words += words
+
+    nll = total_nll / total_words
+    return {"nll": nll, "perplexity": math.exp(nll)}
+
+
+def wrap_loss(model):
+    """The loss of `model`, its gradients synchronized when running distributed.
+    Tail clusters of the adaptive softmax get no gradient when a batch has no
+    word of theirs."""
+    return wrap_model(
+        LossModule(model.to(config.device)),
+        find_unused_parameters=model.dec.adaptive is not None,
+    )
+
+
+def get_model(dataset):
+    cmapping, tmapping = dataset.get_cap_mapping, dataset.get_term_mapping
+
+    enc = TermEncoder(len(tmapping), 2048)
+    dec = SentenceDecoderWithAttention(
+        len(cmapping),
+        2048,
+        len(cmapping),
+        cutoffs=second_stage["adaptive_softmax_cutoffs"],
+        frequencies=cmapping.frequencies(),
+    )
+    return LanguageGenerator(enc, dec)
 
 
 def main():
+    experiment_folder = config.experiment_folder
+    main_process = is_main_process()
+
     dataset = second_stage_dataset()
 
-    writer = SummaryWriter(experiment_folder)
+    writer = SummaryWriter(experiment_folder) if main_process else None
 
     cmapping, tmapping = dataset.get_cap_mapping, dataset.get_term_mapping
 
-    enc = TermEncoder(len(tmapping), 2048)
-    dec = SentenceDecoderWithAttention(len(cmapping), 2048, len(cmapping))
-    lang = LanguageGenerator(enc, dec)
+    lang = get_model(dataset)
+    print(
+        f"Vocabulary sizes: terms {len(tmapping)}, captions {len(cmapping)}, "
+        f"parameters: {count_parameters(lang)}"
+    )
 
     criterion = nn.NLLLoss(ignore_index=0)
     optimizer = torch.optim.Adam(lang.parameters(), lr=second_stage["learning_rate"])
+    checkpointer = Checkpointer("second_stage", lang, optimizer)
+    if config.resume:
+        checkpointer.resume()
+    loss_module = wrap_loss(lang)
+
+    try:
+        for i in range(checkpointer.epoch, second_stage["epochs"]):
+            print(f"Epoch {i}")
+            lang = train(
+                lang,
+                loss_module,
+                dataset,
+                cmapping,
+                criterion,
+                optimizer,
+                writer,
+                i,
+                checkpointer=checkpointer,
+            )
+            checkpointer.epoch_done(i, experiment_folder / f"language_ep{i:03d}.pth")
+    finally:
+        checkpointer.close()
+
+
+def benchmark(steps, ready=None):
+    """Runs `steps` training steps. Returns the number of samples processed and
+    the seconds they took, see first_stage.benchmark."""
+    dataset = second_stage_dataset()
+    lang = get_model(dataset)
+    criterion = nn.NLLLoss(ignore_index=0)
+    optimizer = torch.optim.Adam(lang.parameters(), lr=second_stage["learning_rate"])
+
+    mapping = dataset.get_cap_mapping
+    loss_module = wrap_loss(lang)
+    if ready is not None:
+        ready()
 
-    for i in range(second_stage["epochs"]):
-        print(f"Epoch {i}")
-        lang = train(lang, dataset, cmapping, criterion, optimizer, writer, i)
-        torch.save(lang.state_dict(), experiment_folder / f"language_ep{i:03d}.pth")
+    start = time.perf_counter()
+    train(lang, loss_module, dataset, mapping, criterion, optimizer, None, 0, steps)
+    return steps * second_stage["batch_size"], time.perf_counter() - start
 
 
 if __name__ == "__main__":
+    from .evaluator import start_if_requested
+
+    parse_args()
+    if second_stage["threads"]:
+        torch.set_num_threads(second_stage["threads"])
+    start_if_requested()
     main()
 
 # %%
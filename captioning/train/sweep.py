@@ -0,0 +1,273 @@
+"""Hyperparameter sweeps: each trial is a training run in its own process, with its
+own experiment number and its own share of the cores.
+
+    python -m captioning.train.sweep space.json -x 100 --stage 1 -n 4
+    python -m captioning.train.sweep space.json -x 200 --random 16
+
+The search space maps settings of config.py to the values to try:
+
+    {"first_stage.learning_rate": [0.001, 0.0003], "first_stage.batch_size": [16, 32]}
+
+Every combination is tried, or with --random N, N random ones. In random search
+a setting can also be drawn from {"uniform": [low, high]} or
+{"log_uniform": [low, high]}. The trials are numbered from -x on, trace their
+steps (--trace) and get their checkpoints scored by train.evaluator. A trial whose
+mean loss over the last `sweep["window"]` steps is worse than the median of the
+other trials at the same step is stopped, to free its cores for the next one.
+The final scores are printed and saved to runs/sweep_NNN.json.
+"""
+import itertools
+import json
+import math
+import os
+import random
+import signal
+import subprocess
+import sys
+import time
+from statistics import fmean, median
+
+from ..config import experiment_path, get_parser, parse_args, sweep
+
+MODULES = {"1": "captioning.train.first_stage", "2": "captioning.train.second_stage"}
+SETTINGS = {"1": "first_stage", "2": "second_stage"}
+TRACES = {"1": "trace_first_stage.jsonl", "2": "trace_second_stage.jsonl"}
+DEFAULT_METRICS = {"1": "bleu", "2": "perplexity"}
+LOWER_IS_BETTER = {"nll", "perplexity"}
+
+
+def grid(space):
+    """All the combinations of the values in `space`."""
+    for values in space.values():
+        if not isinstance(values, list):
+            raise ValueError(f"Grid search needs lists of values, got {values}")
+    for combination in itertools.product(*space.values()):
+        yield dict(zip(space, combination))
+
+
+def draw(values, rng):
+    if isinstance(values, list):
+        return rng.choice(values)
+    distribution, (low, high) = next(iter(values.items()))
+    if distribution == "uniform":
+        return rng.uniform(low, high)
+    if distribution == "log_uniform":
+        return math.exp(rng.uniform(math.log(low), math.log(high)))
+    raise ValueError(f"Unknown distribution {distribution}")
+
+
+def sample(space, n, seed=None):
+    """`n` random combinations of the values in `space`."""
+    rng = random.Random(seed)
+    for _ in range(n):
+        yield {key: draw(values, rng) for key, values in space.items()}
+
+
+def split_cores(parallel):
+    """The cores this process may use, split into `parallel` disjoint sets (fewer
+    if there aren't enough cores)."""
+    cores = sorted(os.sched_getaffinity(0))
+    parallel = min(parallel, len(cores))
+    per_trial = len(cores) // parallel
+    return [set(cores[i * per_trial : (i + 1) * per_trial]) for i in range(parallel)]
+
+
+class Trial:
+    def __init__(self, experiment, params, stage):
+        self.experiment = experiment
+        self.params = params
+        self.stage = stage
+        self.folder = experiment_path(experiment)
+        self.process = None
+        self.cores = None
+        self.status = "pending"
+        self.losses = {}  # step: loss
+        self._trace_offset = 0
+
+    def start(self, cores):
+        """Runs the training pinned to `cores`, in its own session so that it can
+        be stopped together with its evaluator."""
+        os.makedirs(self.folder, exist_ok=True)
+        overrides = [f"{key}={value!r}" for key, value in self.params.items()]
+        overrides.append(f"{SETTINGS[self.stage]}.threads={len(cores)}")
+        command = [
+            sys.executable,
+            "-m",
+            MODULES[self.stage],
+            "-x",
+            str(self.experiment),
+            "--trace",
+            "--background_eval",
+            *itertools.chain.from_iterable(("--set", o) for o in overrides),
+        ]
+        env = dict(os.environ, OMP_NUM_THREADS=str(len(cores)))
+        with open(self.folder / "sweep.log", "a") as log:
+            self.process = subprocess.Popen(
+                command,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                start_new_session=True,
+                preexec_fn=lambda: os.sched_setaffinity(0, cores),
+            )
+        self.cores = cores
+        self.status = "running"
+
+    def read_losses(self):
+        """Adds the steps traced since the last call."""
+        path = self.folder / TRACES[self.stage]
+        if not path.exists():
+            return
+        with open(path) as f:
+            f.seek(self._trace_offset)
+            for line in f:
+                if not line.endswith("\n"):  # being written
+                    break
+                record = json.loads(line)
+                self.losses[record["step"]] = record["loss"]
+                self._trace_offset += len(line)
+
+    def mean_loss(self, step, window=None):
+        window = sweep["window"] if window is None else window
+        steps = range(step - window + 1, step + 1)
+        losses = [self.losses[s] for s in steps if s in self.losses]
+        return fmean(losses) if losses else math.inf
+
+    def last_step(self):
+        return max(self.losses, default=-1)
+
+    def running(self):
+        """Whether the training or its evaluator still run."""
+        self.process.poll()  # reap the training, zombies count as running
+        try:
+            os.killpg(self.process.pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+    def stop(self):
+        os.killpg(self.process.pid, signal.SIGTERM)
+        self.status = "stopped"
+
+    def scores(self):
+        """The scores of the last checkpoint, see train.evaluator."""
+        path = self.folder / "scores.jsonl"
+        if not path.exists():
+            return {}
+        records = [json.loads(line) for line in path.read_text().splitlines()]
+        return max(records, key=lambda r: r["step"])
+
+
+def should_stop(trial, trials):
+    """Median stopping rule."""
+    step = trial.last_step()
+    if step < sweep["grace_steps"]:
+        return False
+    others = [
+        other.mean_loss(step)
+        for other in trials
+        if other is not trial and other.last_step() >= step
+    ]
+    if len(others) < sweep["min_trials"]:
+        return False
+    return trial.mean_loss(step) > median(others)
+
+
+def run(trials, parallel):
+    free_cores = split_cores(parallel)
+    pending, running = list(trials), []
+    while pending or running:
+        while pending and free_cores:
+            trial = pending.pop(0)
+            trial.start(free_cores.pop())
+            running.append(trial)
+            print(f"exp_{trial.experiment:03d} started: {trial.params}")
+
+        time.sleep(sweep["poll"])
+
+        for trial in running:
+            trial.read_losses()
+        for trial in running:
+            training = trial.process.poll() is None
+            if training and trial.status == "running" and should_stop(trial, trials):
+                trial.stop()
+                print(f"exp_{trial.experiment:03d} stopped at {trial.last_step()}")
+
+        for trial in [t for t in running if not t.running()]:
+            if trial.status == "running":
+                trial.status = "done" if trial.process.returncode == 0 else "failed"
+            print(f"exp_{trial.experiment:03d} {trial.status}")
+            running.remove(trial)
+            free_cores.append(trial.cores)
+
+
+def report(trials, metric, output):
+    rows = []
+    for trial in trials:
+        scores = trial.scores()
+        rows.append(
+            {
+                "experiment": trial.experiment,
+                "status": trial.status,
+                "steps": trial.last_step() + 1,
+                **trial.params,
+                **scores,
+            }
+        )
+
+    worst = math.inf if metric in LOWER_IS_BETTER else -math.inf
+    rows.sort(
+        key=lambda row: row.get(metric, worst), reverse=metric not in LOWER_IS_BETTER
+    )
+    with open(output, "w") as f:
+        json.dump(rows, f, indent=2)
+
+    columns = ["experiment", "status", "steps", *trials[0].params, metric]
+    print(" ".join(f"{column:>14.14}" for column in columns))
+    for row in rows:
+        print(" ".join(f"{str(row.get(column, '-')):>14.14}" for column in columns))
+    print(f"Saved to {output}")
+
+
+def main():
+    parser = get_parser()
+    parser.add_argument("space", help="JSON file with the search space")
+    parser.add_argument("--stage", choices=["1", "2"], default="1")
+    parser.add_argument("-n", "--parallel", type=int, help='sweep["parallel"]')
+    parser.add_argument("--random", type=int, metavar="N", help="random search")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--metric", help="defaults to bleu, perplexity for stage 2")
+    args = parse_args(parser=parser)
+
+    with open(args.space) as f:
+        space = json.load(f)
+    if args.random is not None:
+        combinations = sample(space, args.random, args.seed)
+    else:
+        combinations = grid(space)
+    trials = [
+        Trial(args.experiment + i, params, args.stage)
+        for i, params in enumerate(combinations)
+    ]
+    if not trials:
+        parser.error(f"No trial to run in {args.space}")
+    # Old traces and scores would be read as those of the new trials
+    used = [
+        str(t.folder) for t in trials if t.folder.exists() and any(t.folder.iterdir())
+    ]
+    if used:
+        parser.error(f"Trial folders already in use, pick another -x: {used}")
+
+    try:
+        run(trials, args.parallel or sweep["parallel"])
+    except KeyboardInterrupt:
+        for trial in trials:
+            if trial.status == "running" and trial.running():
+                trial.stop()
+
+    metric = args.metric or DEFAULT_METRICS[args.stage]
+    report(trials, metric, f"runs/sweep_{args.experiment:03d}.json")
+
+
+if __name__ == "__main__":
+    main()
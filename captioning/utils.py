@@ -36,21 +36,45 @@ def ask_overwrite(path: str) -> bool:
     return get_yn_response(f"{path} already present. Overwrite? [y/N]")
 
 
+def count_parameters(model) -> int:
+    return sum(p.numel() for p in model.parameters())
+
+
 class WordIdxMap:
-    def __init__(self, words):
+    specials = ["<unk>", "<start>", "<end>", "<shake_modern>", "<shake_orig>"]
+
+    def __init__(self, words, min_count=1):
+        """
+        Args:
+            words (iterable or dict): The vocabulary. If a dict of word counts is
+                given, words occurring less than `min_count` times are left out
+                and will be mapped to <unk>.
+            min_count (int, optional): Defaults to 1.
+        """
+        self.counts = {}
         if isinstance(words, dict):
-            words = words.keys()
+            self.counts = {w: c for w, c in words.items() if c >= min_count}
+            words = self.counts.keys()
 
         self.idx2word = list(
             # We want <pad> to be indexed as 0
             chain(
                 ["<pad>"],
                 words,
-                ["<unk>", "<start>", "<end>", "<shake_modern>", "<shake_orig>"],
+                self.specials,
             )
         )
         self.word2idx = {w: i for i, w in enumerate(self.idx2word)}
 
+    @classmethod
+    def from_idx2word(cls, idx2word, counts=None):
+        """Restores a mapping from its `idx2word` (and `counts`)."""
+        mapping = cls.__new__(cls)
+        mapping.counts = dict(counts or {})
+        mapping.idx2word = list(idx2word)
+        mapping.word2idx = {w: i for i, w in enumerate(mapping.idx2word)}
+        return mapping
+
     def __getitem__(self, x):
         if isinstance(x, torch.Tensor) and prod(x.size()) == 1:
             x = x.item()
@@ -67,6 +91,27 @@ class WordIdxMap:
     def decode(self, encoded_caption):
         return (self[idx] for idx in encoded_caption)
 
+    def frequencies(self):
+        """Occurrence counts aligned with the indices.
+
+        Special tokens get the count of the most frequent word, as <start> and <end>
+        appear in every caption. <pad> is never predicted and gets 0.
+        """
+        top = max(self.counts.values(), default=1)
+        return [
+            0 if w == "<pad>" else top if w in self.specials else self.counts.get(w, 0)
+            for w in self.idx2word
+        ]
+
+    def remap_to(self, other):
+        """Translation table from our indices to indices of `other`. Words missing
+        in `other` are mapped to its <unk>.
+
+        Returns:
+            LongTensor: of size (len(self), )
+        """
+        return torch.LongTensor([other[w] for w in self.idx2word])
+
     def prepare_for_training(self, words, max_caption_len, terms=False):
         words = words[: max_caption_len - 2]
         # Dont surround with start end if in terms mode